@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+'''
+Benchmarks the pylude render pipeline stage by stage on synthetic scripts.
+
+    python benchmark.py                          # every size at both resolutions
+    python benchmark.py --sizes 30s --resolutions api --save-baseline
+    python benchmark.py --baseline benchmark-baseline.json --max-regression 0.2
+
+Each stage runs in a fresh process so peak RSS is that stage's alone; bytes
+written is the size of what a stage leaves on disk.
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import ffmpeg
+
+import pylude
+from pylude import framesCreate, framesScript
+
+
+ABSOLUTE_ROOT_PATH = os.path.dirname(os.path.abspath(__file__))
+MEDIA_PATH = os.path.join(ABSOLUTE_ROOT_PATH, 'media')
+LVG_DIRS = {
+    'fonts_dir': os.path.join(MEDIA_PATH, 'fonts'),
+    'bgimages_dir': os.path.join(MEDIA_PATH, 'bgimages'),
+}
+
+SCRIPT_SIZES = {
+    '30s': 30,
+    '3min': 3 * 60,
+    '10min': 10 * 60,
+}
+
+## pylude defaults and what the video API renders
+RESOLUTIONS = {
+    'default': {},
+    'api': {
+        'width': 1080,
+        'height': 1920,
+        'font_height': 150,
+        'margin_left_right': 15,
+        'bgcolor': (227, 247, 255),
+        'textcolor': (0, 160, 224),
+        'textcolor_current': (68, 167, 207),
+        'textcolor_next': (169, 228, 252),
+    },
+}
+
+WORDS = ("love night light heart fire dream rain river sky song dance shadow "
+         "golden morning stay away again forever together alone running home "
+         "wild free burning whisper echo falling rising ocean").split()
+
+STAGES = ['generate_framedata', 'generate_frames', 'generate_video', 'attach_audio', 'encode_video']
+
+
+def synthetic_script(filepath, seconds, word_pause_ms, seed=7):
+    '''
+    Lyrics with as many words as fit the duration, 4-9 words a line,
+    punctuated line ends and a blank line every few lines for page breaks.
+    '''
+    rand = random.Random(seed)
+    words_left = int(seconds * 1000 / word_pause_ms)
+    lines = []
+    while words_left > 0:
+        count = min(words_left, rand.randint(4, 9))
+        line = " ".join(rand.choice(WORDS) for _ in range(count))
+        lines.append(line + rand.choice(['', '', ',', '.', '!']))
+        if rand.randint(0, 5) == 0:
+            lines.append("")
+        words_left -= count
+    with open(filepath, 'w', encoding='utf-8') as fp:
+        fp.write("\n".join(lines) + "\n")
+    return filepath
+
+
+def synthetic_audio(filepath, seconds):
+    (
+        ffmpeg
+        .input('sine=frequency=220:duration=%d' % seconds, format='lavfi')
+        .output(filepath, acodec='aac')
+        .global_args('-loglevel', 'error')
+        .overwrite_output()
+        .run()
+    )
+    return filepath
+
+
+def disk_usage(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total
+
+
+def peak_rss_bytes():
+    ## ru_maxrss is in KiB on linux; ffmpeg runs as a child so gets counted separately
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * 1024
+
+
+def timed(stage_func, output_path=None, frames=None):
+    started = time.perf_counter()
+    value = stage_func()
+    wall = time.perf_counter() - started
+    stats = {
+        'wall_seconds': round(wall, 4),
+        'frames_per_second': round(frames / wall, 2) if frames and wall > 0 else None,
+        'peak_rss_bytes': peak_rss_bytes(),
+        'bytes_written': disk_usage(output_path) if output_path and os.path.exists(output_path) else 0,
+    }
+    return value, stats
+
+
+def case_files(case, work_dir):
+    case_dir = os.path.join(work_dir, case['name'])
+    return {
+        'script': os.path.join(case_dir, 'text', 'song'),
+        'audio': os.path.join(case_dir, 'song.m4a'),
+        'framedata_dir': os.path.join(case_dir, 'framedata'),
+        'frames_dir': os.path.join(case_dir, 'frames'),
+        'video_tmp': os.path.join(case_dir, 'video', 'tmp.mp4'),
+        'video': os.path.join(case_dir, 'video', 'attached.mp4'),
+        'encoded': os.path.join(case_dir, 'video', 'encoded.mp4'),
+    }
+
+
+def case_frame_specs(case):
+    frame_specs = dict(RESOLUTIONS[case['resolution']])
+    frame_specs['bgimage_id'] = case['bgimage']
+    frame_specs['font_path'] = os.path.join(LVG_DIRS['fonts_dir'], framesCreate.DEFAULT_FONTS[case['font']])
+    return framesCreate.with_default_frame_specs(LVG_DIRS, frame_specs)
+
+
+def run_stage(stage, files, frame_specs, framedata_file, frames_total):
+    '''
+    Runs one stage on what the earlier ones left in files,
+    returns what it made along with its stats.
+    '''
+    if stage == 'generate_framedata':
+        return timed(lambda: pylude.generate_framedata(files['script'], files['framedata_dir']))
+    if stage == 'generate_frames':
+        return timed(lambda: pylude.generate_frames(framedata_file, files['frames_dir'], LVG_DIRS, frame_specs),
+                     files['frames_dir'], frames_total)
+    if stage == 'generate_video':
+        return timed(lambda: pylude.generate_video(files['frames_dir'], files['video_tmp'], frame_specs['fps']),
+                     files['video_tmp'], frames_total)
+    if stage == 'attach_audio':
+        return timed(lambda: pylude.attach_audio(files['video_tmp'], files['audio'], files['video']),
+                     files['video'])
+    ## the streaming path the video API takes, render and encode in one go
+    video_size = (frame_specs['width'], frame_specs['height'])
+    return timed(lambda: pylude.encode_video(
+                     pylude.generate_frames_stream(framedata_file, LVG_DIRS, frame_specs),
+                     files['audio'], files['encoded'], frame_specs['fps'], video_size),
+                 files['encoded'], frames_total)
+
+
+def run_stage_process(stage, case, files, framedata_file, frames_total, result_queue):
+    try:
+        value, stats = run_stage(stage, files, case_frame_specs(case), framedata_file, frames_total)
+        result_queue.put({'value': value, 'stats': stats})
+    except Exception as e:
+        result_queue.put({'error': repr(e)})
+
+
+def run_isolated(stage, case, files, framedata_file, frames_total, timeout):
+    '''
+    Runs a stage in a process of its own so its peak RSS is not mixed
+    with earlier stages; a crash or running past timeout seconds
+    comes back as an error instead of waiting on the result forever.
+    '''
+    context = multiprocessing.get_context('spawn')
+    result_queue = context.Queue()
+    process = context.Process(target=run_stage_process,
+                              args=(stage, case, files, framedata_file, frames_total, result_queue))
+    process.start()
+    started = time.perf_counter()
+    result = None
+    while result is None:
+        try:
+            result = result_queue.get(timeout=1)
+        except queue.Empty:
+            if not process.is_alive():
+                ## a result put right before exiting may still be on its way
+                try:
+                    result = result_queue.get(timeout=1)
+                except queue.Empty:
+                    result = {'error': "%s exited with code %s" % (stage, process.exitcode)}
+            elif timeout is not None and time.perf_counter() - started > timeout:
+                process.terminate()
+                result = {'error': "%s ran past %ds" % (stage, timeout)}
+    process.join()
+    return result
+
+
+def run_case(case, work_dir, timeout=None):
+    seconds = SCRIPT_SIZES[case['size']]
+    files = case_files(case, work_dir)
+    for sub_dir in ['text', 'framedata', 'frames', 'video']:
+        os.makedirs(os.path.join(work_dir, case['name'], sub_dir), exist_ok=True)
+    synthetic_script(files['script'], seconds, int(framesScript.DEFAULT_WORD_PAUSE_MILLISECOND))
+    synthetic_audio(files['audio'], seconds)
+
+    results = {}
+    framedata_file = None
+    frames_total = None
+    for stage in STAGES:
+        result = run_isolated(stage, case, files, framedata_file, frames_total, timeout)
+        if 'error' in result:
+            return {'case': case, 'error': result['error']}
+        results[stage] = result['stats']
+        if stage == 'generate_framedata':
+            framedata_file = result['value']
+            frames_total = framesCreate.count_frames(framedata_file, case_frame_specs(case))
+    return {'case': case, 'frames_total': frames_total, 'stages': results}
+
+
+def cases_for(args):
+    cases = []
+    for size in args.sizes:
+        for resolution in args.resolutions:
+            for font in args.fonts:
+                for bgimage in args.bgimages:
+                    cases.append({
+                        'name': "%s-%s-%s-%s" % (size, resolution, font, bgimage),
+                        'size': size,
+                        'resolution': resolution,
+                        'font': font,
+                        'bgimage': bgimage,
+                    })
+    return cases
+
+
+def compare(results, baseline, max_regression):
+    '''
+    Prints wall time change per stage against baseline,
+    returns False when a stage got slower than max_regression allows.
+    '''
+    baseline_cases = {result['case']['name']: result for result in baseline['results']}
+    within_limit = True
+    for result in results:
+        name = result['case']['name']
+        if 'error' in result or name not in baseline_cases or 'error' in baseline_cases[name]:
+            continue
+        for stage in STAGES:
+            now = result['stages'][stage]['wall_seconds']
+            before = baseline_cases[name]['stages'][stage]['wall_seconds']
+            if before <= 0:
+                continue
+            change = (now - before) / before
+            flag = ''
+            if max_regression is not None and change > max_regression:
+                flag = '  << slower'
+                within_limit = False
+            print("%-44s %-20s %8.3fs -> %8.3fs %+7.1f%%%s" % (name, stage, before, now, 100 * change, flag))
+    return within_limit
+
+
+def report(results):
+    print("%-44s %-20s %10s %10s %12s %14s" % ('case', 'stage', 'wall s', 'frames/s', 'peak rss MB', 'written MB'))
+    for result in results:
+        name = result['case']['name']
+        if 'error' in result:
+            print("%-44s failed: %s" % (name, result['error']))
+            continue
+        for stage in STAGES:
+            stats = result['stages'][stage]
+            print("%-44s %-20s %10.3f %10s %12.1f %14.2f" % (
+                name, stage, stats['wall_seconds'],
+                stats['frames_per_second'] if stats['frames_per_second'] is not None else '-',
+                stats['peak_rss_bytes'] / 2**20, stats['bytes_written'] / 2**20))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pylude render pipeline.")
+    parser.add_argument('--sizes', nargs='+', choices=list(SCRIPT_SIZES), default=list(SCRIPT_SIZES))
+    parser.add_argument('--resolutions', nargs='+', choices=list(RESOLUTIONS), default=list(RESOLUTIONS))
+    parser.add_argument('--fonts', nargs='+', choices=list(framesCreate.DEFAULT_FONTS), default=['caviardreams-bi'])
+    parser.add_argument('--bgimages', nargs='+', default=['musical-night'],
+                        help="background ids from media/bgimages, 'plain' for a solid colour")
+    parser.add_argument('--output', help="write results as JSON here")
+    parser.add_argument('--baseline', help="compare against results saved earlier")
+    parser.add_argument('--save-baseline', nargs='?', const='benchmark-baseline.json',
+                        help="save results as the new baseline")
+    parser.add_argument('--max-regression', type=float,
+                        help="exit 1 when a stage is slower than baseline by more than this fraction")
+    parser.add_argument('--keep', action='store_true', help="keep generated frames and videos")
+    parser.add_argument('--timeout', type=float, help="fail a stage running longer than this many seconds")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='lvg-bench-')
+    try:
+        results = [run_case(case, work_dir, args.timeout) for case in cases_for(args)]
+    finally:
+        if args.keep:
+            print("kept benchmark files at %s" % work_dir)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report(results)
+    summary = {'version': pylude.__VERSION__, 'results': results}
+    for filepath in [args.output, args.save_baseline]:
+        if filepath:
+            with open(filepath, 'w') as fp:
+                json.dump(summary, fp, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        if not compare(results, baseline, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
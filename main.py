@@ -9,10 +9,21 @@ import os
 from babel.dates import format_date, format_time
 from babel.numbers import format_decimal
 import logging
+import uuid
+import functools
+import contextlib
+import tempfile
+import hashlib
+import asyncio
+import concurrent.futures
+import queue
+import threading
+import time
+import math
 
-import whisper
 
 import pylude  ## local relative import
+from pylude import metrics
 print("pyLuDe activated version: %s" % pylude.__VERSION__)
 
 ##### Globals
@@ -24,15 +35,61 @@ IMAGE_PATH  = os.path.join(STATIC_PATH, 'img')
 
 MEDIA_PATH = os.path.join(ABSOLUTE_ROOT_PATH, 'media')
 AUDIO_PATH = os.path.join(MEDIA_PATH, 'audio')
+UPLOADS_PATH = os.path.join(MEDIA_PATH, 'uploads')
 TEXT_PATH = os.path.join(MEDIA_PATH, 'text')
-FRAMEDATA_PATH = os.path.join(MEDIA_PATH, 'framedata')
+TRANSCRIPTS_PATH = os.path.join(MEDIA_PATH, 'transcripts')
 FRAMES_PATH = os.path.join(MEDIA_PATH, 'frames')
 VIDEO_PATH = os.path.join(MEDIA_PATH, 'video')
+SEGMENTS_PATH = os.path.join(MEDIA_PATH, 'segments')
 FONTS_PATH = os.path.join(MEDIA_PATH, 'fonts')
 BGIMAGES_DIR = os.path.join(MEDIA_PATH, 'bgimages')
+LVG_DIRS = {'fonts_dir': FONTS_PATH, 'bgimages_dir': BGIMAGES_DIR}
+
+## video renders run off the event loop, at most these many at a time
+VIDEO_JOBS_WORKERS = int(os.environ.get('LUDE_VIDEO_JOBS_WORKERS', '1'))
+VIDEO_JOBS_HISTORY = 256
+## fast, balanced or quality, see pylude.videoCreate.ENCODE_PRESETS
+VIDEO_ENCODE_PRESET = os.environ.get('LUDE_VIDEO_ENCODE_PRESET', 'balanced')
+## vfr encodes each distinct frame once with its duration instead of repeating it
+VIDEO_FRAME_RATE_MODE = os.environ.get('LUDE_VIDEO_FRAME_RATE_MODE', 'cfr')
+## 'steps' lights words up a few letters at a time, 'wipe' sweeps across them every frame
+VIDEO_HIGHLIGHT_STYLE = os.environ.get('LUDE_VIDEO_HIGHLIGHT_STYLE', 'steps')
+## cfr renders get encoded as segments by line, so re-rendering an edited script only
+## encodes the segments it changed; least recently used ones get evicted past this size
+VIDEO_SEGMENTS = os.environ.get('LUDE_VIDEO_SEGMENTS', '1') not in ['', '0']
+VIDEO_SEGMENTS_MAX_BYTES = int(os.environ.get('LUDE_VIDEO_SEGMENTS_MAX_BYTES', str(1024 * 1024 * 1024)))
+## mp4 links a video once it is complete, hls links a playlist that grows while rendering
+VIDEO_FORMAT = os.environ.get('LUDE_VIDEO_FORMAT', 'mp4')
+VIDEO_FORMATS = {'mp4': '.mp4', 'hls': '.m3u8'}
+## (width, height, font_height) rendered unless a request lists its own targets
+VIDEO_DEFAULT_TARGET = (1080, 1920, 150)
+VIDEO_TARGETS_MAX = 4
+VIDEO_TARGET_MAX_SIZE = 4096
+
+## concurrent transcriptions get decoded together, waiting this long to fill a batch
+TRANSCRIBE_BATCH_SIZE = int(os.environ.get('LUDE_TRANSCRIBE_BATCH_SIZE', '4'))
+TRANSCRIBE_BATCH_WAIT = float(os.environ.get('LUDE_TRANSCRIBE_BATCH_WAIT_MS', '50')) / 1000
+## long tracks get transcribed as whisper sized windows overlapping by a few seconds
+TRANSCRIBE_WINDOW_SECONDS = 30
+TRANSCRIBE_OVERLAP_SECONDS = float(os.environ.get('LUDE_TRANSCRIBE_OVERLAP_S', '2'))
+## at most this many words get heard twice, sung lyrics rarely go past 3 a second
+TRANSCRIBE_OVERLAP_WORDS = math.ceil(TRANSCRIBE_OVERLAP_SECONDS * 3)
+
+## whisper, torch & the model only get loaded once a transcription needs them,
+## LUDE_WHISPER_PREWARM loads the model in the background at startup instead
+WHISPER_MODEL_NAME = os.environ.get('LUDE_WHISPER_MODEL', 'base')
+WHISPER_DEVICE = os.environ.get('LUDE_WHISPER_DEVICE') or None  ## whisper picks cuda when available
+WHISPER_PREWARM = os.environ.get('LUDE_WHISPER_PREWARM', '') not in ['', '0']
+TRANSCRIBE_DECODING_OPTIONS = {'fp16': False}
+## machine transcripts cached by audio content, oldest used get evicted past this size
+TRANSCRIPT_CACHE_MAX_BYTES = int(os.environ.get('LUDE_TRANSCRIPT_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+## audio is stored as media/audio/<sha256><ext>, uploads past this size get refused
+UPLOAD_MAX_BYTES = int(os.environ.get('LUDE_UPLOAD_MAX_BYTES', str(50 * 1024 * 1024)))
 
 DEFAULT_LOCALE = 'en'
 LOCALE_DIR = 'locales'
+JINJA_CACHE_PATH = os.path.join(TEMP_PATH, 'jinja')
 
 def get_supported_languages(locale_dir):
     return [x for x in os.listdir(locale_dir)
@@ -58,49 +115,350 @@ def trim_path(absolute_path, trim_path):
 
 ##### Funcs & Resources
 
-def load_whisper_model():
-    model = whisper.load_model("base")
-    print("Model Device: %s" % model.device)
-    return model
+JOBS_IN_FLIGHT = metrics.define('lude_jobs_in_flight', 'gauge', "Transcriptions and video renders running right now.")
+VIDEO_JOBS_STATE = metrics.define('lude_video_jobs', 'gauge', "Video jobs held in job history by state.")
+VIDEO_JOBS_FINISHED = metrics.define('lude_video_jobs_total', 'counter', "Video jobs finished by outcome.")
 
-def transcribe(audio_id):
-    filepath = os.path.join(TEXT_PATH, f'{audio_id}')
-    if os.path.isfile(filepath):
-        print("%s transcription exists, returning that" % filepath)
-        with open(filepath, 'r') as fp:
-            return fp.readlines()
-    model = WHISPER_MODEL
-    audio_file = os.path.join(AUDIO_PATH, audio_id)
-    audio = whisper.load_audio(audio_file)
-    audio = whisper.pad_or_trim(audio)  ## this trims audio to 1min, on local machine the run panics otherwise
-
-    # make log-Mel spectrogram and move to the same device as the model
-    mel = whisper.log_mel_spectrogram(audio).to(model.device)
-
-    # detect the spoken language
-    _, probs = model.detect_language(mel)
-    print(f"Detected language: {max(probs, key=probs.get)}")
-
-    # decode the audio
-    options = whisper.DecodingOptions(fp16=False)
-    result = whisper.decode(model, mel, options)
-    with open(filepath, 'w') as fp:
-        fp.write(result.text)
-    return result.text
-
-
-def get_template_locale(locale_dir):
+WHISPER_MODELS = {}
+WHISPER_MODELS_LOCK = threading.Lock()
+
+
+def whisper_model(name=WHISPER_MODEL_NAME, device=WHISPER_DEVICE):
+    '''
+    Loaded whisper models by (name, device), the first caller loads it.
+    '''
+    with WHISPER_MODELS_LOCK:
+        if (name, device) not in WHISPER_MODELS:
+            import whisper
+            with metrics.timed(metrics.STAGE_SECONDS, stage='model_load'):
+                model = whisper.load_model(name, device=device)
+            print("Model %s Device: %s" % (name, model.device))
+            WHISPER_MODELS[(name, device)] = model
+        return WHISPER_MODELS[(name, device)]
+
+
+def settle_future(settle, value):
+    ## a failure handing over one result must never stop the worker thread
+    try:
+        settle(value)
+    except Exception as e:
+        print(e)
+
+
+class TranscribeWorker:
+    '''
+    Owns the whisper model on a dedicated thread, requests arriving together get
+    micro-batched into one mel tensor for detect_language and decode.
+    '''
+    def __init__(self, load_model, batch_size, batch_wait):
+        self.load_model = load_model
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='whisper-worker', daemon=True)
+        self.thread.start()
+
+    def submit(self, mel):
+        future = concurrent.futures.Future()
+        self.requests.put((mel, future))
+        return future
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            ## requests cancelled while queued get dropped, the rest can't be cancelled anymore
+            batch = [(mel, future) for mel, future in self.next_batch()
+                     if future.set_running_or_notify_cancel()]
+            if len(batch) == 0:
+                continue
+            try:
+                results = self.decode_batch([mel for mel, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    settle_future(future.set_exception, e)
+                continue
+            for (_, future), result in zip(batch, results):
+                settle_future(future.set_result, result)
+
+    def decode_batch(self, mels):
+        import torch
+        import whisper
+        model = self.load_model()
+        mel_batch = torch.stack(mels).to(model.device)
+
+        # detect the spoken language
+        with metrics.timed(metrics.STAGE_SECONDS, stage='detect_language'):
+            _, probs = model.detect_language(mel_batch)
+        for lang_probs in probs:
+            print(f"Detected language: {max(lang_probs, key=lang_probs.get)}")
+
+        # decode the audio
+        options = whisper.DecodingOptions(**TRANSCRIBE_DECODING_OPTIONS)
+        with metrics.timed(metrics.STAGE_SECONDS, stage='decode'):
+            return [result.text for result in whisper.decode(model, mel_batch, options)]
+
+
+def iter_audio_windows(audio_file, window_seconds, overlap_seconds):
+    '''
+    Yields overlapping windows of 16kHz mono float32 samples as ffmpeg decodes them,
+    only one window is held in memory whatever the length of the track.
+    '''
+    import ffmpeg
+    import numpy
+    import whisper
+    window = int(window_seconds * whisper.audio.SAMPLE_RATE)
+    step = window - int(overlap_seconds * whisper.audio.SAMPLE_RATE)
+    process = (
+        ffmpeg
+        .input(audio_file, threads=0)
+        .output('-', format='s16le', acodec='pcm_s16le', ac=1, ar=whisper.audio.SAMPLE_RATE)
+        .global_args('-nostdin', '-loglevel', 'error')
+        .run_async(pipe_stdout=True, pipe_stderr=True)
+    )
+    buffered = numpy.zeros(0, dtype=numpy.float32)
+    windows_count = 0
+    try:
+        while True:
+            data = process.stdout.read((window - len(buffered)) * 2)
+            samples = numpy.frombuffer(data, numpy.int16).astype(numpy.float32) / 32768.0
+            buffered = numpy.concatenate([buffered, samples])
+            if len(buffered) < window:
+                ## ffmpeg is done once the output runs short, an unreadable upload must not pass for silence
+                if process.wait() != 0:
+                    raise RuntimeError("ffmpeg failed to decode %s: %s"
+                                       % (audio_file, process.stderr.read().decode(errors='replace').strip()))
+                if windows_count == 0 and len(buffered) == 0:
+                    raise RuntimeError("found no audio in %s" % audio_file)
+                ## tail of the track, unless previous window already covered it
+                if windows_count == 0 or len(buffered) > (window - step):
+                    yield buffered
+                break
+            yield buffered
+            windows_count += 1
+            buffered = buffered[step:]
+    finally:
+        process.stdout.close()
+        process.stderr.close()
+        process.wait()
+
+
+def window_mel(audio):
+    import whisper
+    audio = whisper.pad_or_trim(audio)
+
+    # make log-Mel spectrogram, worker moves it to the same device as the model
+    return whisper.log_mel_spectrogram(audio)
+
+
+def stitch_words(words, next_words, max_overlap=TRANSCRIBE_OVERLAP_WORDS):
+    '''
+    Appends next_words dropping the longest run already at the end of words,
+    windows overlap so their edges get transcribed twice; runs longer than the
+    overlap could hold are left alone, those are lyrics that really repeat.
+    '''
+    def plain(word):
+        return word.strip('.,!?;:"\'').lower()
+    for size in range(min(len(words), len(next_words), max_overlap), 0, -1):
+        if [plain(word) for word in words[-size:]] == [plain(word) for word in next_words[:size]]:
+            return words + next_words[size:]
+    return words + next_words
+
+
+async def transcribe_windows(audio_file):
+    '''
+    Yields the transcript so far after each window, windows get submitted a batch
+    at a time so the worker decodes them together.
+    '''
+    windows = iter_audio_windows(audio_file, TRANSCRIBE_WINDOW_SECONDS, TRANSCRIBE_OVERLAP_SECONDS)
+    words = []
+    try:
+        while True:
+            mels = []
+            while len(mels) < TRANSCRIBE_BATCH_SIZE:
+                with metrics.timed(metrics.STAGE_SECONDS, stage='audio_load'):
+                    audio = await asyncio.to_thread(next, windows, None)
+                if audio is None:
+                    break
+                with metrics.timed(metrics.STAGE_SECONDS, stage='mel'):
+                    mels.append(await asyncio.to_thread(window_mel, audio))
+            if len(mels) == 0:
+                break
+            futures = [TRANSCRIBE_WORKER.submit(mel) for mel in mels]
+            for future in futures:
+                words = stitch_words(words, (await asyncio.wrap_future(future)).split())
+                yield ' '.join(words)
+            if len(mels) < TRANSCRIBE_BATCH_SIZE:
+                break
+    finally:
+        windows.close()
+
+
+def audio_file_path(audio_id):
+    '''
+    Audio of an upload, each upload id maps to the content-addressed file it
+    shares with identical uploads; audio uploaded before that is named by its id.
+    '''
+    upload_file = os.path.join(UPLOADS_PATH, audio_id)
+    if os.path.isfile(upload_file):
+        with open(upload_file) as fp:
+            return os.path.join(AUDIO_PATH, fp.read().strip())
+    return os.path.join(AUDIO_PATH, audio_id)
+
+
+def audio_digest(audio_id):
+    '''
+    SHA-256 of the uploaded audio, recorded next to it by upload_audio;
+    audio uploaded before that gets hashed once here.
+    '''
+    audio_file = audio_file_path(audio_id)
+    digest_file = audio_file + '.sha256'
+    if os.path.isfile(digest_file):
+        with open(digest_file) as fp:
+            return fp.read().strip()
+    digest = pylude.hash_file(audio_file)
+    with open(digest_file, 'w') as fp:
+        fp.write(digest)
+    return digest
+
+
+def transcript_cache_key(audio_id):
+    options = {
+        'decoding': TRANSCRIBE_DECODING_OPTIONS,
+        'window_seconds': TRANSCRIBE_WINDOW_SECONDS,
+        'overlap_seconds': TRANSCRIBE_OVERLAP_SECONDS,
+    }
+    key = "%s:%s:%s" % (audio_digest(audio_id), WHISPER_MODEL_NAME, json.dumps(options, sort_keys=True))
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def transcript_cache_get(cache_key):
+    filepath = os.path.join(TRANSCRIPTS_PATH, cache_key)
+    if not os.path.isfile(filepath):
+        return None
+    os.utime(filepath)  ## mtime tracks last use for eviction
+    with open(filepath, 'r') as fp:
+        return fp.read()
+
+
+def transcript_cache_put(cache_key, text):
+    filepath = os.path.join(TRANSCRIPTS_PATH, cache_key)
+    with open(filepath + '.tmp', 'w') as fp:
+        fp.write(text)
+    os.replace(filepath + '.tmp', filepath)
+    metrics.inc(metrics.BYTES_WRITTEN, os.path.getsize(filepath), kind='transcript')
+    cached = [os.path.join(TRANSCRIPTS_PATH, name) for name in os.listdir(TRANSCRIPTS_PATH)
+                if not name.startswith('.') and not name.endswith('.tmp')]
+    cached.sort(key=os.path.getmtime)
+    cached_bytes = sum(os.path.getsize(path) for path in cached)
+    for path in cached[:-1]:
+        if cached_bytes <= TRANSCRIPT_CACHE_MAX_BYTES:
+            break
+        cached_bytes -= os.path.getsize(path)
+        os.remove(path)
+
+
+def save_script(audio_id, text):
+    ## transcript becomes the script to edit, unless the user already has one
+    script_filepath = os.path.join(TEXT_PATH, audio_id)
+    if not os.path.isfile(script_filepath):
+        with open(script_filepath, 'w') as fp:
+            fp.write(text)
+
+
+def load_script(audio_id):
+    script_filepath = os.path.join(TEXT_PATH, audio_id)
+    if not os.path.isfile(script_filepath):
+        return None
+    with open(script_filepath, 'r') as fp:
+        return fp.read()
+
+
+async def transcribe_partials(audio_id):
+    ## a saved script is what the user works with, edits included
+    text = load_script(audio_id)
+    if text is not None:
+        print("%s already has a script, returning that" % audio_id)
+        yield text
+        return
+    cache_key = await asyncio.to_thread(transcript_cache_key, audio_id)
+    text = transcript_cache_get(cache_key)
+    if text is not None:
+        metrics.inc(metrics.CACHE_HITS, cache='transcript')
+        print("%s transcription cached as %s, returning that" % (audio_id, cache_key))
+        save_script(audio_id, text)
+        yield text
+        return
+    metrics.inc(metrics.CACHE_MISSES, cache='transcript')
+    audio_file = audio_file_path(audio_id)
+    text = ''
+    with metrics.in_flight(JOBS_IN_FLIGHT, kind='transcription'):
+        async for text in transcribe_windows(audio_file):
+            yield text
+    transcript_cache_put(cache_key, text)
+    save_script(audio_id, text)
+
+
+async def transcribe(audio_id):
+    transcription = None
+    async for transcription in transcribe_partials(audio_id):
+        pass
+    return transcription
+
+
+async def transcription_stream(audio_id):
+    try:
+        async for transcription in transcribe_partials(audio_id):
+            yield (json.dumps({'success': True, 'done': False, 'text': transcription}) + '\n').encode()
+    except Exception as e:
+        print(e)
+        yield (json.dumps({'success': False, 'error': "Failed to transcribe audio"}) + '\n').encode()
+        return
+    yield (json.dumps({'success': True, 'done': True}) + '\n').encode()
+
+
+def get_template_locale(locale, bytecode_cache):
     tmpl = jinja2.Environment(
         extensions=['jinja2.ext.i18n'],
-        loader=jinja2.FileSystemLoader('templates')
+        loader=jinja2.FileSystemLoader('templates'),
+        bytecode_cache=bytecode_cache,
+        auto_reload=False  ## templates & rendered pages are kept until restart
     )
-    tmpl.install_gettext_translations(TRANSLATIONS[DEFAULT_LOCALE])
+    tmpl.install_gettext_translations(TRANSLATIONS[locale])
     tmpl.filters['num_filter'] = num_filter
     tmpl.filters['date_filter'] = date_filter
     tmpl.filters['time_filter'] = time_filter
     return tmpl
 
 
+def get_templates(cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+    return {lang: get_template_locale(lang, bytecode_cache) for lang in SUPPORTED_LANGS}
+
+
+@functools.lru_cache(maxsize=64)
+def render_page(locale, template_name, data_items):
+    '''
+    Rendered page and its ETag, memoised per locale & data;
+    data_items is the template data as a sorted tuple of items.
+    '''
+    template = TEMPLATES[locale].get_template(template_name)
+    page = template.render(**dict(data_items), locale=locale)
+    return page, hashlib.sha256(page.encode()).hexdigest()[:32]
+
+
 def get_active_locale(context, locale):
     if context:
         context_locale = context.get('locale', DEFAULT_LOCALE)
@@ -132,35 +490,81 @@ class MainResource:
         if(locale not in SUPPORTED_LANGS):
             locale = DEFAULT_LOCALE
 
-        tmpl = get_template_locale(LOCALE_DIR)
-        tmpl.install_gettext_translations(TRANSLATIONS[locale])
-
         # mock data
         data = {
             "event_date": datetime.date(2021, 12, 4),
             "event_time": datetime.time(10, 30, 0)
         }
 
-        resp.status = falcon.HTTP_200
+        page, etag = render_page(locale, "index.html", tuple(sorted(data.items())))
+        resp.etag = etag
+        resp.cache_control = ['no-cache']  ## browsers revalidate with If-None-Match
         resp.content_type = 'text/html'
-        template = tmpl.get_template("index.html")
-        resp.text = template.render(**data, locale=locale)
+        if req.if_none_match and (etag in req.if_none_match or '*' in req.if_none_match):
+            resp.status = falcon.HTTP_304
+            return
+        resp.status = falcon.HTTP_200
+        resp.text = page
+
+
+def upload_too_large():
+    return falcon.HTTPPayloadTooLarge(
+        title="Audio too large",
+        description="Audio uploads are limited to %d bytes." % UPLOAD_MAX_BYTES
+    )
 
 
-async def upload_audio(req, name, audio_id):
-    filepath = None
+def store_upload(temp_filepath, digest, extension):
+    '''
+    Moves a finished upload to its content-addressed name, identical audio
+    uploaded earlier is kept as is and the new copy dropped; returns a new
+    id for this upload, its script & frames are kept under that id.
+    '''
+    audio_name = digest + extension
+    filepath = os.path.join(AUDIO_PATH, audio_name)
+    if os.path.isfile(filepath):
+        os.remove(temp_filepath)
+    else:
+        with open(filepath + '.sha256', 'w') as fp:
+            fp.write(digest)
+        os.replace(temp_filepath, filepath)
+        metrics.inc(metrics.BYTES_WRITTEN, os.path.getsize(filepath), kind='audio')
+    audio_id = uuid.uuid4().hex
+    with open(os.path.join(UPLOADS_PATH, audio_id), 'w') as fp:
+        fp.write(audio_name)
+    return audio_id
+
+
+async def upload_audio(req, name):
+    if req.content_length is not None and req.content_length > UPLOAD_MAX_BYTES:
+        raise upload_too_large()
     form = await req.get_media()
     async for part in form:
-        if filepath == None:
-            audio_id = "%s-%s" % (audio_id, part.secure_filename)
-            filepath = os.path.join(AUDIO_PATH, f'{audio_id}')
-            fp = open(filepath, 'ab')
-        if part.name == name:
-            # Do something with the uploaded data (file)
+        if part.name != name:
+            continue
+        # stream into a temp file off the event loop, hashing as the bytes arrive
+        sha256 = hashlib.sha256()
+        size = 0
+        fd, temp_filepath = tempfile.mkstemp(prefix='.upload-', dir=AUDIO_PATH)
+        fp = os.fdopen(fd, 'wb')
+        try:
             async for chunk in part.stream:
-                fp.write(chunk)
-    fp.close()
-    return audio_id
+                size += len(chunk)
+                if size > UPLOAD_MAX_BYTES:
+                    raise upload_too_large()
+                sha256.update(chunk)
+                await asyncio.to_thread(fp.write, chunk)
+            await asyncio.to_thread(fp.close)
+            extension = os.path.splitext(part.secure_filename)[1].lower()
+            return await asyncio.to_thread(store_upload, temp_filepath, sha256.hexdigest(), extension)
+        finally:
+            fp.close()
+            if os.path.isfile(temp_filepath):
+                os.remove(temp_filepath)
+    raise falcon.HTTPBadRequest(
+        title="Missing audio",
+        description="No '%s' part found in the upload." % name
+    )
 
 
 async def update_transcript(req, audio_id):
@@ -173,8 +577,13 @@ async def update_transcript(req, audio_id):
 
 class APITranscribeResource:
     async def on_get(self, req, resp, audio_id):
+        if req.get_param_as_bool('stream', default=False):
+            resp.status = falcon.HTTP_200
+            resp.content_type = 'application/x-ndjson'
+            resp.stream = transcription_stream(audio_id)
+            return
         try:
-            transcription = transcribe(audio_id)
+            transcription = await transcribe(audio_id)
         except Exception as e:
             print(e)
             raise falcon.HTTPInternalServerError(
@@ -202,6 +611,266 @@ class APITranscribeResource:
         resp.text = json.dumps({'success': True, 'task': 'script updated'})
 
 
+def video_frame_specs(bgimage_id, target=VIDEO_DEFAULT_TARGET):
+    width, height, font_height = target
+    return {
+        'width': width,
+        'height': height,
+        'font_height': font_height,
+        'margin_left_right': 15,
+        'bgcolor': (227, 247, 255),
+        'textcolor': (0, 160, 224),
+        'textcolor_current': (68, 167, 207),
+        'textcolor_next': (169, 228, 252),
+        'highlight_style': VIDEO_HIGHLIGHT_STYLE,
+        'bgimage_id': bgimage_id
+    }
+
+
+def video_target_name(target):
+    return "%dx%dx%d" % target
+
+
+def parse_video_targets(targets_param):
+    '''
+    Targets from a 'WIDTHxHEIGHT[xFONT_HEIGHT],...' query value, font height
+    defaults to the default target's scaled by the shorter side.
+    '''
+    if not targets_param:
+        return [VIDEO_DEFAULT_TARGET]
+    targets = []
+    for target_param in targets_param.split(','):
+        try:
+            sizes = [int(size) for size in target_param.strip().lower().split('x')]
+        except ValueError:
+            sizes = []
+        if len(sizes) == 2:
+            sizes.append(round(VIDEO_DEFAULT_TARGET[2] * min(sizes) / min(VIDEO_DEFAULT_TARGET[:2])))
+        if (len(sizes) != 3 or not all(16 <= size <= VIDEO_TARGET_MAX_SIZE for size in sizes)
+                or sizes[0] % 2 or sizes[1] % 2):
+            raise falcon.HTTPBadRequest(
+                title="Invalid video target",
+                description="Targets are WIDTHxHEIGHT[xFONT_HEIGHT] with even sizes up to %d, got '%s'."
+                            % (VIDEO_TARGET_MAX_SIZE, target_param)
+            )
+        if tuple(sizes) not in targets:
+            targets.append(tuple(sizes))
+    if len(targets) > VIDEO_TARGETS_MAX:
+        raise falcon.HTTPBadRequest(
+            title="Too many video targets",
+            description="At most %d targets can be rendered together." % VIDEO_TARGETS_MAX
+        )
+    return targets
+
+
+def parse_video_format(format_param):
+    video_format = format_param or VIDEO_FORMAT
+    if video_format not in VIDEO_FORMATS:
+        raise falcon.HTTPBadRequest(
+            title="Invalid video format",
+            description="Formats are %s, got '%s'." % (", ".join(VIDEO_FORMATS), video_format)
+        )
+    return video_format
+
+
+def prepare_video(audio_id, bgimage_id, targets, video_format):
+    '''
+    Generates framedata once and resolves frame specs for each target,
+    returns them with the render cache key of each resulting video.
+    '''
+    script_filepath = os.path.join(TEXT_PATH, audio_id)
+    framedata = pylude.script_framedata(script_filepath)
+    digest = audio_digest(audio_id)
+    renders = []
+    for target in targets:
+        frame_specs = pylude.with_default_frame_specs(LVG_DIRS, video_frame_specs(bgimage_id, target))
+        ## hls always streams constant frame rate
+        frame_rate_mode = VIDEO_FRAME_RATE_MODE if video_format == 'mp4' else 'cfr'
+        render_key = pylude.render_key(framedata, frame_specs, digest,
+                                       VIDEO_ENCODE_PRESET, frame_rate_mode, video_format)
+        renders.append({'target': video_target_name(target), 'frame_specs': frame_specs,
+                        'render_key': render_key, 'format': video_format})
+    return framedata, renders
+
+
+def video_file_path(render_key, video_format='mp4'):
+    return os.path.join(VIDEO_PATH, render_key + VIDEO_FORMATS[video_format])
+
+
+def video_link(render):
+    return trim_path(video_file_path(render['render_key'], render['format']), MEDIA_PATH)
+
+
+def video_rendered(render):
+    my_video_file = video_file_path(render['render_key'], render['format'])
+    if render['format'] == 'hls':
+        return pylude.hls_playlist_complete(my_video_file)
+    return os.path.isfile(my_video_file)
+
+
+@contextlib.contextmanager
+def render_key_lock(render_key):
+    ## jobs with overlapping targets, or a recreate, wait for the render in progress
+    with VIDEO_JOBS_LOCK:
+        key_lock = RENDER_KEY_LOCKS.setdefault(render_key, [threading.Lock(), 0])
+        key_lock[1] += 1
+    try:
+        with key_lock[0]:
+            yield
+    finally:
+        with VIDEO_JOBS_LOCK:
+            key_lock[1] -= 1
+            if key_lock[1] == 0:
+                del RENDER_KEY_LOCKS[render_key]
+
+
+def render_target(job, framedata, render):
+    '''
+    Renders one target, a render key only gets rendered by one job at a time;
+    a job that waited on another skips what got rendered in the meantime.
+    '''
+    with render_key_lock(render['render_key']):
+        if video_rendered(render) and not job['recreate']:
+            add_job_frames(job, pylude.count_frames(framedata, render['frame_specs']))
+            return video_file_path(render['render_key'], render['format'])
+        return do_render_target(job, framedata, render)
+
+
+def do_render_target(job, framedata, render):
+    audio_id = job['audio_id']
+    frame_specs = render['frame_specs']
+    my_video_file = video_file_path(render['render_key'], render['format'])
+    video_fps = frame_specs['fps']
+    video_size = (frame_specs['width'], frame_specs['height'])
+    my_audio_file = audio_file_path(audio_id)
+    if render['format'] == 'hls':
+        ## segments of an earlier, unfinished render get written anew
+        for my_hls_file in pylude.hls_files(my_video_file):
+            os.remove(my_hls_file)
+        frames = pylude.generate_frames_stream(framedata, LVG_DIRS, frame_specs)
+        pylude.encode_video_hls(track_job_frames(job, frames), my_audio_file, my_video_file,
+                                video_fps, video_size, VIDEO_ENCODE_PRESET)
+        return my_video_file
+    ## encoded next to the cached name and moved in place once complete
+    my_part_file = os.path.splitext(my_video_file)[0] + ".part.mp4"
+    if os.path.isfile(my_part_file):
+        print("removing file: %s" % my_part_file)
+        os.remove(my_part_file)
+    if VIDEO_SEGMENTS and VIDEO_FRAME_RATE_MODE == 'cfr':
+        pylude.encode_video_segments(framedata, my_audio_file, my_part_file, frame_specs,
+                                     SEGMENTS_PATH, VIDEO_ENCODE_PRESET,
+                                     functools.partial(add_job_frames, job), reuse=not job['recreate'])
+        pylude.evict_segments(SEGMENTS_PATH, VIDEO_SEGMENTS_MAX_BYTES)
+    else:
+        ## frames go straight to the encoder, my_frames_dir only gets used with LVG_DEBUG_FRAMES
+        my_frames_dir = os.path.join(FRAMES_PATH, audio_id)
+        frames = pylude.generate_frames_stream(framedata, LVG_DIRS, frame_specs, my_frames_dir)
+        encode_video = VIDEO_ENCODERS[VIDEO_FRAME_RATE_MODE]
+        encode_video(track_job_frames(job, frames), my_audio_file, my_part_file,
+                     video_fps, video_size, VIDEO_ENCODE_PRESET)
+    os.replace(my_part_file, my_video_file)
+    return my_video_file
+
+
+def render_video(job, framedata, renders):
+    '''
+    Renders every target of the job from the same framedata, targets get
+    rendered side by side so each encoder runs alongside the others.
+    '''
+    job['frames_total'] = sum(pylude.count_frames(framedata, render['frame_specs']) for render in renders)
+    if len(renders) == 1:
+        render_target(job, framedata, renders[0])
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(renders)) as executor:
+        futures = [executor.submit(render_target, job, framedata, render) for render in renders]
+        for future in futures:
+            future.result()
+
+
+def add_job_frames(job, frames_count):
+    with VIDEO_JOBS_LOCK:
+        job['frames_done'] += frames_count
+
+
+def track_job_frames(job, frames):
+    for rgb_frame, repeat in frames:
+        yield (rgb_frame, repeat)
+        add_job_frames(job, repeat)
+
+
+def finish_video_job(job):
+    for video in job['videos']:
+        video['video_link'] = video_link(video)
+    job['video_link'] = job['videos'][0]['video_link']
+    job['state'] = 'done'
+
+
+def run_video_job(job, framedata, renders):
+    job['state'] = 'running'
+    try:
+        with metrics.in_flight(JOBS_IN_FLIGHT, kind='video'):
+            render_video(job, framedata, renders)
+        if not all(video_rendered(render) for render in renders):
+            job['state'] = 'failed'
+            job['description'] = "The process completed but no video file can be located."
+            return
+        finish_video_job(job)
+    except Exception as e:
+        print(e)
+        job['state'] = 'failed'
+        job['description'] = "An issue occurred while generating the video."
+    finally:
+        metrics.inc(VIDEO_JOBS_FINISHED, outcome=job['state'])
+
+
+def add_video_job(audio_id, renders, recreate=False):
+    ## hls playlists are linked right away, players pick up segments as they land
+    videos = [{'target': render['target'], 'render_key': render['render_key'], 'format': render['format'],
+               'video_link': video_link(render) if render['format'] == 'hls' else None}
+              for render in renders]
+    job = {
+        'job_id': uuid.uuid4().hex,
+        'audio_id': audio_id,
+        'render_keys': [render['render_key'] for render in renders],
+        'recreate': recreate,
+        'state': 'queued',
+        'frames_done': 0,
+        'frames_total': None,
+        'video_link': videos[0]['video_link'],
+        'videos': videos,
+        'description': "Generate lyrical video from transcript & attached audio.",
+    }
+    VIDEO_JOBS[job['job_id']] = job
+    ## forget the oldest finished jobs once history grows past the limit
+    finished = [job_id for job_id, old_job in VIDEO_JOBS.items() if old_job['state'] in ['done', 'failed']]
+    for job_id in finished[:max(0, len(finished) - VIDEO_JOBS_HISTORY)]:
+        del VIDEO_JOBS[job_id]
+    return job
+
+
+def submit_video_job(audio_id, framedata, renders, recreate):
+    '''
+    Queues a render of the targets not rendered yet, unless the same targets are
+    being rendered right now; recreate renders every target again.
+    '''
+    render_keys = [render['render_key'] for render in renders]
+    if not recreate:
+        for job in VIDEO_JOBS.values():
+            if job['render_keys'] == render_keys and job['state'] in ['queued', 'running']:
+                return job
+    job = add_video_job(audio_id, renders, recreate)
+    pending = [render for render in renders
+               if recreate or not video_rendered(render)]
+    metrics.inc(metrics.CACHE_HITS, len(renders) - len(pending), cache='render')
+    metrics.inc(metrics.CACHE_MISSES, len(pending), cache='render')
+    if len(pending) == 0:
+        finish_video_job(job)
+        job['description'] = "Reusing the video generated earlier from the same inputs."
+        return job
+    VIDEO_JOBS_EXECUTOR.submit(run_video_job, job, framedata, pending)
+    return job
+
+
 class APIVideoResource:
     async def on_get(self, req, resp):
         resp.status = falcon.HTTP_400
@@ -210,71 +879,43 @@ class APIVideoResource:
         return
 
     async def on_post(self, req, resp, audio_id):
-        recreate = False
-        bgimage_id = 'plain'
-        for key, value in req.params.items():
-            if key == 'recreate':
-                recreate = value
-            if key == 'bgimage':
-                bgimage_id = value
-        description = "Generate lyrical video from transcript & attached audio."
-        my_video_file = os.path.join(VIDEO_PATH, audio_id)
-        my_video_file = os.path.splitext(my_video_file)[0] + ".mp4"
+        recreate = req.get_param_as_bool('recreate', default=False)
+        bgimage_id = req.get_param('bgimage', default='plain')
+        targets = parse_video_targets(req.get_param('targets'))
+        video_format = parse_video_format(req.get_param('format'))
         try:
-            script_filepath = os.path.join(TEXT_PATH, audio_id)
-            framedata_file = pylude.generate_framedata(script_filepath, FRAMEDATA_PATH)
-
-            my_frames_dir = os.path.join(FRAMES_PATH, audio_id)
-            lvg_dirs = {'fonts_dir': FONTS_PATH, 'bgimages_dir': BGIMAGES_DIR}
-            frame_specs = {
-                'width': 1080,
-                'height': 1920,
-                'font_height': 150,
-                'margin_left_right': 15,
-                'bgcolor': (227, 247, 255),
-                'textcolor': (0, 160, 224),
-                'textcolor_current': (68, 167, 207),
-                'textcolor_next': (169, 228, 252),
-                'bgimage_id': bgimage_id
-            };
-            frame_specs = pylude.generate_frames(framedata_file, my_frames_dir, lvg_dirs, frame_specs)
-
-            video_fps = frame_specs['fps']
-            vdo_tmp = os.path.join(TEMP_PATH, audio_id)
-            vdo_tmp = os.path.splitext(vdo_tmp)[0] + ".mp4"
-            if os.path.isfile(vdo_tmp) and recreate:
-                print("removing file: %s" % vdo_tmp)
-                os.remove(vdo_tmp)
-            pylude.generate_video(my_frames_dir, vdo_tmp, video_fps)
-
-            my_audio_file = os.path.join(AUDIO_PATH, audio_id)
-            if os.path.isfile(my_video_file) and recreate:
-                print("removing file: %s" % my_video_file)
-                os.remove(my_video_file)
-            if not pylude.attach_audio(vdo_tmp, my_audio_file, my_video_file):
-                description = "Failed to attach audio."
+            framedata, renders = await asyncio.to_thread(prepare_video, audio_id, bgimage_id, targets, video_format)
         except Exception as e:
             print(e)
             raise falcon.HTTPInternalServerError(
-              success=False,
-              error="Failed to generate video",
-              description="An issue occurred while generating the video."
-            )
-        if not os.path.isfile(my_video_file):
-            raise falcon.HTTPInternalServerError(
-                success=False,
-                error="Failed to generate video",
-                description="The process completed but no video file can be located."
+                title="Failed to generate video",
+                description="An issue occurred while preparing the video."
             )
-        resp.status = falcon.HTTP_200
+        job = submit_video_job(audio_id, framedata, renders, recreate)
+        resp.status = falcon.HTTP_200 if job['state'] == 'done' else falcon.HTTP_202
         resp.content_type = 'application/json'
         resp.text = json.dumps({
             'success': True,
-            'video_link': trim_path(my_video_file, MEDIA_PATH),
-            'description': description,
+            'job_id': job['job_id'],
+            'job_link': '/api/jobs/%s' % job['job_id'],
+            'state': job['state'],
+            'video_link': job['video_link'],
+            'videos': job['videos'],
         })
 
 
+class APIJobResource:
+    async def on_get(self, req, resp, job_id):
+        if job_id not in VIDEO_JOBS:
+            raise falcon.HTTPNotFound(
+                title="Unknown job",
+                description="No video job found for %s." % job_id
+            )
+        resp.status = falcon.HTTP_200
+        resp.content_type = 'application/json'
+        resp.text = json.dumps(dict(VIDEO_JOBS[job_id], success=True))
+
+
 class APIAudioResource:
     async def on_get(self, req, resp):
         resp.status = falcon.HTTP_400
@@ -283,9 +924,10 @@ class APIAudioResource:
         return
 
     async def on_post(self, req, resp):
-        audio_id = "default_filename" # str(uuid.uuid4())
         try:
-            audio_id = await upload_audio(req, 'file', audio_id)
+            audio_id = await upload_audio(req, 'file')
+        except falcon.HTTPError:
+            raise
         except Exception as e:
             print(e)
             raise falcon.HTTPInternalServerError(
@@ -298,11 +940,104 @@ class APIAudioResource:
         resp.text = json.dumps({'success': True, 'audio_id': audio_id})
 
 
+async def file_range_stream(filepath, offset, length, chunk_size=256 * 1024):
+    ## ASGI servers give no sendfile, chunks get read off the event loop instead
+    with open(filepath, 'rb') as fp:
+        await asyncio.to_thread(fp.seek, offset)
+        while length > 0:
+            chunk = await asyncio.to_thread(fp.read, min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+VIDEO_CONTENT_TYPES = {
+    '.mp4': 'video/mp4',
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.m4s': 'video/iso.segment',
+}
+
+
+class VideoResource:
+    '''
+    Serves rendered videos and hls playlists with their segments, with byte ranges
+    for seeking; files are named by their render cache key which, with the mtime,
+    makes a strong ETag.
+    '''
+    async def on_get(self, req, resp, filename):
+        await self.serve(req, resp, filename, with_body=True)
+
+    async def on_head(self, req, resp, filename):
+        await self.serve(req, resp, filename, with_body=False)
+
+    async def serve(self, req, resp, filename, with_body):
+        filepath = os.path.join(VIDEO_PATH, filename)
+        extension = os.path.splitext(filename)[1]
+        if filename != os.path.basename(filename) or extension not in VIDEO_CONTENT_TYPES or not os.path.isfile(filepath):
+            raise falcon.HTTPNotFound()
+        stat = await asyncio.to_thread(os.stat, filepath)
+        etag = "%s-%x" % (os.path.splitext(filename)[0], stat.st_mtime_ns)
+        last_modified = datetime.datetime.utcfromtimestamp(int(stat.st_mtime))
+
+        resp.etag = etag
+        resp.last_modified = last_modified
+        resp.cache_control = ['public', 'max-age=31536000']
+        if extension == '.m3u8' and not await asyncio.to_thread(pylude.hls_playlist_complete, filepath):
+            resp.cache_control = ['no-cache']  ## still growing, players reload it
+        resp.accept_ranges = 'bytes'
+        resp.content_type = VIDEO_CONTENT_TYPES[extension]
+        if req.if_none_match:
+            if etag in req.if_none_match or '*' in req.if_none_match:
+                resp.status = falcon.HTTP_304
+                return
+        elif req.if_modified_since and last_modified <= req.if_modified_since:
+            resp.status = falcon.HTTP_304
+            return
+
+        size = stat.st_size
+        start, end = 0, size - 1
+        resp.status = falcon.HTTP_200
+        if_range = req.get_header('If-Range')
+        if req.range is not None and (if_range is None or if_range.strip('"') == etag):
+            start, end = req.range
+            if start < 0:  ## suffix range, the last -start bytes
+                start, end = max(0, size + start), size - 1
+            elif end < 0 or end >= size:
+                end = size - 1
+            if start >= size or start > end:
+                raise falcon.HTTPRangeNotSatisfiable(size)
+            resp.status = falcon.HTTP_206
+            resp.content_range = (start, end, size)
+        resp.content_length = end - start + 1
+        if with_body:
+            resp.stream = file_range_stream(filepath, start, end - start + 1)
+
+
+class MetricsResource:
+    async def on_get(self, req, resp):
+        states = {state: 0 for state in ['queued', 'running', 'done', 'failed']}
+        for job in list(VIDEO_JOBS.values()):
+            states[job['state']] += 1
+        for state, count in states.items():
+            metrics.set_gauge(VIDEO_JOBS_STATE, count, state=state)
+        resp.status = falcon.HTTP_200
+        resp.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        resp.text = metrics.exposition()
+
+
 class RedirectResource:
     async def on_get(self, req, resp):
         raise falcon.HTTPFound(req.prefix + '/en/main')
 
 
+class PrewarmMiddleware:
+    async def process_startup(self, scope, event):
+        if WHISPER_PREWARM:
+            ## not awaited, pages get served while the model loads
+            asyncio.get_running_loop().run_in_executor(None, whisper_model)
+
+
 class PlainTextHandler(media.BaseHandler):
     def serialize(self, media, content_type):
         return str(media).encode()
@@ -317,25 +1052,40 @@ logging.basicConfig(
     format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO
 )
 
-WHISPER_MODEL = load_whisper_model()
+TEMPLATES = get_templates(JINJA_CACHE_PATH)
+TRANSCRIBE_WORKER = TranscribeWorker(whisper_model, TRANSCRIBE_BATCH_SIZE, TRANSCRIBE_BATCH_WAIT)
+
+VIDEO_JOBS = {}
+VIDEO_JOBS_LOCK = threading.Lock()
+RENDER_KEY_LOCKS = {}
+VIDEO_ENCODERS = {
+    'cfr': pylude.encode_video,
+    'vfr': pylude.encode_video_vfr,
+}
+VIDEO_JOBS_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=VIDEO_JOBS_WORKERS)
 
 mainHandler = MainResource()
 apiAudioHandler = APIAudioResource()
 apiVideoHandler = APIVideoResource()
 apiTranscribeHandler = APITranscribeResource()
+apiJobHandler = APIJobResource()
+videoHandler = VideoResource()
+metricsHandler = MetricsResource()
 redirect = RedirectResource()
 
 extra_handlers = {
     'text/plain': PlainTextHandler(),
 }
 
-app = falcon.asgi.App()
+app = falcon.asgi.App(middleware=[PrewarmMiddleware()])
 app.req_options.media_handlers.update(extra_handlers)
 app.add_static_route('/pages', STATIC_PATH)
 app.add_static_route('/img', IMAGE_PATH)
-app.add_static_route('/video', VIDEO_PATH)
+app.add_route('/video/{filename}', videoHandler)
 app.add_route('/{locale}/main', mainHandler)
 app.add_route('/api/audio', apiAudioHandler)
 app.add_route('/api/transcribe/{audio_id}', apiTranscribeHandler)
 app.add_route('/api/video/{audio_id}', apiVideoHandler)
+app.add_route('/api/jobs/{job_id}', apiJobHandler)
+app.add_route('/metrics', metricsHandler)
 app.add_route('/', redirect)
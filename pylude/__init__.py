@@ -1,6 +1,9 @@
 
 __VERSION__ = "0.0.1-beta"
 
-from . framesCreate import generate_frames
-from . framesScript import generate_framedata
-from . videoCreate import generate_video, attach_audio
+from . framesCreate import generate_frames, generate_frames_stream, count_frames, with_default_frame_specs
+from . framesScript import generate_framedata, script_framedata
+from . framesData import FramedataRow, read_framedata_csv, write_framedata_csv
+from . videoCreate import generate_video, stream_video, encode_video, encode_video_vfr, encode_video_hls, hls_playlist_complete, hls_files, attach_audio
+from . renderCache import render_key, hash_file
+from . videoSegments import encode_video_segments, evict_segments
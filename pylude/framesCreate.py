@@ -1,251 +1,335 @@
 #!/usr/bin/env python
 
-import csv
+import collections
+import concurrent.futures
 import math
+import multiprocessing
 import os
 import random
-import re
+import threading
 from PIL import Image, ImageDraw, ImageFont
-import functools
-
-def do_generate_frames(framedata_file, frames_dir, frame_specs):
-    @functools.lru_cache(maxsize=128)
-    def line_need_break(line):
-        if bool(re.match(r".*[\.,!\:;\?]\s*$", line)):
-            return True
-        return False
-
-
-    @functools.lru_cache(maxsize=128)
-    def last_line_y(current_y):
-        return current_y - (FRAME_SPECS['font_height'] + FRAME_SPECS['default_line_gap'])
-
-
-    @functools.lru_cache(maxsize=128)
-    def next_line_y(current_y):
-        return current_y + FRAME_SPECS['font_height'] + FRAME_SPECS['default_line_gap']
-
-
-    @functools.lru_cache(maxsize=128)
-    def line_x_middle(line_width, shabda_width):
-        x_text = (FRAME_SPECS['width'] - line_width) / 2
-        if (line_width + shabda_width) < FRAME_SPECS['width']: x_text -= (shabda_width/2)
-        return x_text
-
-
-    @functools.lru_cache(maxsize=128)
-    def line_shabda_x_middle(line_width, shabda_width):
-        x_text = line_x_middle(line_width, shabda_width)
-        x_shabda = (FRAME_SPECS['width'] - shabda_width) / 2
-        if (x_text + line_width + shabda_width + FRAME_SPECS['margin_left_right']) < FRAME_SPECS['width']:
-            x_shabda = x_text + line_width
-        return x_shabda
-
-
-    @functools.lru_cache(maxsize=128)
-    def line_x_left(_line_width, _shabda_width):
-        return FRAME_SPECS['margin_left_right']
-
-
-    @functools.lru_cache(maxsize=128)
-    def line_shabda_x_left(line_width, shabda_width):
-        x_text = FRAME_SPECS['margin_left_right']
-        x_shabda = FRAME_SPECS['margin_left_right']
-
-        if (x_text + line_width + FRAME_SPECS['margin_left_right']) < FRAME_SPECS['width']:
-            x_shabda = x_text + line_width - shabda_width
-        return x_shabda
-
-
-    @functools.lru_cache(maxsize=128)
-    def line_x(line_width, shabda_width):
-        return {
-            'default': line_x_middle,
-            'middle': line_x_middle,
-            'left': line_x_left,
-        }[FRAME_SPECS['line_indentation_style']](line_width, shabda_width)
-
-
-    @functools.lru_cache(maxsize=128)
-    def line_shabda_x(line_width, shabda_width):
-        return {
-            'default': line_shabda_x_middle,
-            'middle': line_shabda_x_middle,
-            'left': line_shabda_x_left,
-        }[FRAME_SPECS['line_indentation_style']](line_width, shabda_width)
-
-
-    @functools.lru_cache(maxsize=128)
-    def next_word_coordinates(line, shabda, y_text, font):
-        line_width, _ = font.getsize(line)
-        shabda_width, _ = font.getsize(' ' + shabda)
-        y_shabda = y_text
-        x_text = line_x(line_width, shabda_width)
-        x_shabda = line_shabda_x(line_width, shabda_width)
-        y_shabda = last_line_y(y_text)
-        return (x_shabda, y_shabda)
-
-
-    @functools.lru_cache(maxsize=128)
-    def allowed_line_count(max_height, font, margin_top=10, buffer=0):
-        possible_count = int(max_height / (next_line_y(margin_top) + buffer))
-        if possible_count < FRAME_SPECS['max_lines_per_frame']:
-            return possible_count
-        return FRAME_SPECS['max_lines_per_frame']
-
-
-    def draw_read_line(canvas, lyric_line, y_text, font, shabda_width=0):
+import logging
+import numpy
+
+from . import metrics
+from . framesData import load_framedata
+from . framesLayout import song_layout, text_width
+from . framesManifest import write_frames_manifest
+
+logger = logging.getLogger(__name__)
+
+def frame_renderer(frame_specs):
+    '''
+    Returns render_row(layout_row) bound to frame_specs, it draws one LayoutRow
+    as computed by song_layout and returns its list of rendered frames.
+    '''
+    def draw_text(canvas, xy, text, color):
         draw = ImageDraw.Draw(canvas)
-        line_width, _ = font.getsize(lyric_line)
-        if line_need_break(lyric_line):
-            shabda_width = 0
-        x_text = line_x(line_width, shabda_width)
-        draw.text(
-            (x_text, y_text),
-            lyric_line,
-            fill=FRAME_SPECS['textcolor'],
-            font=font)
-        y_text = next_line_y(y_text)
+        draw.text(xy, text, fill=color, font=DEFAULT_FONT)
         del draw
-        return y_text
 
 
-    def draw_next_word(canvas, last_line, shabda, x_coordinates, font, color):
-        draw = ImageDraw.Draw(canvas)
-        draw.text(
-            x_coordinates,
-            ' ' + shabda,
-            fill=color,
-            font=font)
-        del draw
+    def save_image_times(frame, frame_index, times, subindex=0):
+        ## a repeated frame is emitted once along with how often to show it
+        times = int(times)
+        if times < 1:
+            return subindex
+        RENDERED_FRAMES.append((frame_index, subindex, frame, times))
+        return subindex + 1
 
 
-    def save_image_times(canvas, frame_index, times, subindex=0):
-        for idx in range(0,int(times)):
-            frame_filepath = os.path.join(FRAMES_DIR, "lvg-%d-%d.png" % (frame_index, subindex))
-            subindex += 1
-            canvas.save(frame_filepath, "PNG")
-        return subindex
-
-    def create_frame_shabda(canvas, frame_index, y_text, for_millisec, line, shabda, font):
-        x_coordinates = next_word_coordinates(line, shabda, y_text, font)
-
-        if len(line) > 0:
-            draw_next_word(canvas, line, shabda, x_coordinates, font, FRAME_SPECS['textcolor_next'])
-
-        frames_count = math.ceil(FRAMES_PER_SECOND * (int(for_millisec)/1000))
-        subindex = 0
-        if len(shabda) < 1:
-            subindex = save_image_times(canvas, frame_index, frames_count, subindex)
-        if len(shabda) < 2:
-            subindex = save_image_times(canvas, frame_index, frames_count/2, subindex)
-            draw_next_word(canvas, line, shabda, x_coordinates, font, FRAME_SPECS['textcolor_current'])
-            subindex = save_image_times(canvas, frame_index, frames_count/2, subindex)
-
-        elif len(shabda) == 2:
-            subindex = save_image_times(canvas, frame_index, int(frames_count/3), subindex)
-            draw_next_word(canvas, line, shabda[0], x_coordinates, font, FRAME_SPECS['textcolor_current'])
-            subindex = save_image_times(canvas, frame_index, int(frames_count/3), subindex)
-            draw_next_word(canvas, line, shabda, x_coordinates, font, FRAME_SPECS['textcolor_current'])
-            subindex = save_image_times(canvas, frame_index, int(frames_count/3), subindex)
-        else:
-            token_size = math.ceil(len(shabda) / 3)
-            subindex = save_image_times(canvas, frame_index, int(frames_count/4), subindex)
-            draw_next_word(canvas, line, shabda[:(token_size)], x_coordinates, font, FRAME_SPECS['textcolor_current'])
-            subindex = save_image_times(canvas, frame_index, int(frames_count/4), subindex)
-            draw_next_word(canvas, line, shabda[:(token_size*2)], x_coordinates, font, FRAME_SPECS['textcolor_current'])
-            subindex = save_image_times(canvas, frame_index, int(frames_count/4), subindex)
-            draw_next_word(canvas, line, shabda, x_coordinates, font, FRAME_SPECS['textcolor_current'])
-            subindex = save_image_times(canvas, frame_index, int(frames_count/4), subindex)
+    def create_frame_shabda(canvas, layout_row):
+        shabda = layout_row.shabda
+        if layout_row.show_next:
+            draw_text(canvas, layout_row.shabda_xy, ' ' + shabda, FRAME_SPECS['textcolor_next'])
+
+        ## frames leave the renderer as RGB arrays
+        frame = numpy.asarray(canvas.convert('RGB') if canvas.mode != 'RGB' else canvas)
+        splits = shabda_frame_splits(FRAMES_PER_SECOND, layout_row.pause_ms, shabda)
+        subindex = save_image_times(frame, layout_row.frame_index, splits[0])
+        highlights = highlight_clips(DEFAULT_FONT, shabda, splits, FRAME_SPECS['highlight_style'])
+        if len(highlights) == 0:
+            return
+        ## the word is rasterised once, each highlight blends it in up to a clip
+        mask, origin = text_mask(DEFAULT_FONT, layout_row.shabda_xy, ' ' + shabda)
+        for clip_width, times in highlights:
+            clip_x = None if clip_width is None else layout_row.shabda_xy[0] + clip_width
+            highlighted = blend_mask(frame, mask, origin, clip_x, FRAME_SPECS['textcolor_current'])
+            subindex = save_image_times(highlighted, layout_row.frame_index, times, subindex)
 
 
     def base_image(bgimage_path):
-        try:
-            bgimage = Image.open(bgimage_path)
-            return bgimage.copy().resize((FRAME_SPECS['width'], FRAME_SPECS['height']))
-        except:
-            return Image.new('RGB', (FRAME_SPECS['width'], FRAME_SPECS['height']), FRAME_SPECS['bgcolor'])
+        return background_image(
+            bgimage_path,
+            (FRAME_SPECS['width'], FRAME_SPECS['height']),
+            FRAME_SPECS['bgcolor'])
 
 
-    def create_frame_image(frame_index, for_millisec, lyric_list, shabda, font):
-        canvas = base_image(BASE_IMAGE_FILE)
+    def read_lines_layer(read_lines):
+        ## background with finished lines, redrawn only when a line wraps or page breaks
+        if READ_LINES_LAYER.get('key') == read_lines:
+            metrics.inc(metrics.CACHE_HITS, cache='read_lines')
+        else:
+            metrics.inc(metrics.CACHE_MISSES, cache='read_lines')
+            canvas = base_image(BASE_IMAGE_FILE)
+            for line, x_text, y_text in read_lines:
+                draw_text(canvas, (x_text, y_text), line, FRAME_SPECS['textcolor'])
+            READ_LINES_LAYER['key'] = read_lines
+            READ_LINES_LAYER['image'] = canvas
+        return READ_LINES_LAYER['image'].copy()
+
+
+    def render_row(layout_row):
+        canvas = read_lines_layer(layout_row.read_lines)
+        line, x_text, y_text = layout_row.current_line
+        draw_text(canvas, (x_text, y_text), line, FRAME_SPECS['textcolor'])
+        create_frame_shabda(canvas, layout_row)
+        # cleaning up to avoid corrupted memory errors
+        del canvas
+        rendered_frames = list(RENDERED_FRAMES)
+        RENDERED_FRAMES.clear()
+        return rendered_frames
 
-        y_text = FRAME_SPECS['margin_top']
-        lines_to_use = allowed_line_count(FRAME_SPECS['height'], font, y_text)
+    ## calling this internal structure scoped structure
+    FRAME_SPECS = frame_specs
+    FRAMES_PER_SECOND = frame_specs['fps']
+    BASE_IMAGE_FILE = frame_specs['base_image_file']
+    DEFAULT_FONT = load_font(frame_specs)
+    RENDERED_FRAMES = []
+    READ_LINES_LAYER = {}
+    return render_row
 
-        line_to_add_from = 0
-        if len(lyric_list) > lines_to_use:
-            line_to_add_from = len(lyric_list) - lines_to_use
 
-        shabda_width, _ = font.getsize(" " + shabda)
+## decoded & resized backgrounds, shared by every render in this process
+BACKGROUND_CACHE = collections.OrderedDict()
+BACKGROUND_CACHE_SIZE = 8
+## target threads share the cache
+BACKGROUND_CACHE_LOCK = threading.Lock()
 
-        lines_already_read = lyric_list[line_to_add_from:-1]
-        line_currently_read = lyric_list[-1]
 
-        for line in lines_already_read:
-            y_text = draw_read_line(canvas, line, y_text, font)
+def load_background_image(bgimage_path, size, bgcolor):
+    if bgimage_path is not None:
+        try:
+            with Image.open(bgimage_path) as bgimage:
+                return bgimage.convert('RGB').resize(size)
+        except (OSError, ValueError) as e:
+            logger.warning("using plain background, failed to load %s: %s", bgimage_path, e)
+    return Image.new('RGB', size, tuple(bgcolor))
+
+
+def background_image(bgimage_path, size, bgcolor):
+    '''
+    Returns a copy of the RGB background of given size, cached by (path, size, mtime);
+    a missing or unreadable image falls back to a plain bgcolor background.
+    '''
+    try:
+        cache_key = (bgimage_path, size, os.path.getmtime(bgimage_path))
+    except (OSError, TypeError):
+        bgimage_path = None
+        cache_key = (None, size, tuple(bgcolor))
+    with BACKGROUND_CACHE_LOCK:
+        bgimage = BACKGROUND_CACHE.get(cache_key)
+        if bgimage is not None:
+            BACKGROUND_CACHE.move_to_end(cache_key)
+    if bgimage is not None:
+        metrics.inc(metrics.CACHE_HITS, cache='background')
+        return bgimage.copy()
+    metrics.inc(metrics.CACHE_MISSES, cache='background')
+    ## decoded outside the lock, a concurrent miss on the same key only decodes it twice
+    bgimage = load_background_image(bgimage_path, size, bgcolor)
+    with BACKGROUND_CACHE_LOCK:
+        BACKGROUND_CACHE[cache_key] = bgimage
+        if len(BACKGROUND_CACHE) > BACKGROUND_CACHE_SIZE:
+            BACKGROUND_CACHE.popitem(last=False)
+    return bgimage.copy()
+
+
+def shabda_frame_splits(frames_per_second, for_millisec, shabda):
+    '''
+    Frames to show a word for at each highlight step, first entry is before any
+    highlight; short words light up in 1 step, 2 letters in 2 and longer in 3.
+    '''
+    frames_count = math.ceil(frames_per_second * (int(for_millisec)/1000))
+    if len(shabda) < 1:
+        return [frames_count + int(frames_count/2), int(frames_count/2)]
+    if len(shabda) < 2:
+        return [int(frames_count/2)] * 2
+    elif len(shabda) == 2:
+        return [int(frames_count/3)] * 3
+    return [int(frames_count/4)] * 4
+
+
+def shabda_highlight(shabda, step, steps):
+    if step >= steps:
+        return shabda
+    token_size = math.ceil(len(shabda) / steps)
+    return shabda[:(token_size*step)]
+
+
+def highlight_clips(font, shabda, splits, highlight_style):
+    '''
+    (clip_width, times) for each highlighted frame after splits[0], clip_width in pixels
+    from the word's x and None for the whole word; 'steps' lights the word up a few
+    letters at a time as split, 'wipe' moves the clip on every frame.
+    '''
+    steps = len(splits) - 1
+    if highlight_style == 'wipe':
+        wipe_frames = sum(int(times) for times in splits[1:])
+        word_width = text_width(font, ' ' + shabda)
+        return [(word_width * frame / wipe_frames if frame < wipe_frames else None, 1)
+                for frame in range(1, wipe_frames + 1)]
+    return [(text_width(font, ' ' + shabda_highlight(shabda, step, steps)) if step < steps else None, times)
+            for step, times in enumerate(splits[1:], start=1)]
+
+
+def text_mask(font, xy, text):
+    '''
+    Coverage of text drawn at xy as a uint8 array along with its (left, top) on the
+    canvas, sub-pixel placement is kept so it matches drawing on the canvas itself.
+    '''
+    left, top, right, bottom = font.getbbox(text)
+    origin = (math.floor(xy[0]) + left - 2, math.floor(xy[1]) + top - 2)
+    mask = Image.new('L', (max(1, right - left + 4), max(1, bottom - top + 4)), 0)
+    ImageDraw.Draw(mask).text((xy[0] - origin[0], xy[1] - origin[1]), text, fill=255, font=font)
+    return numpy.asarray(mask), origin
+
+
+def blend_mask(frame, mask, origin, clip_x, color):
+    '''
+    Copy of the RGB frame with color blended in through mask left of clip_x,
+    or through all of it when clip_x is None.
+    '''
+    frame = frame.copy()
+    height, width = frame.shape[:2]
+    x0, y0 = max(0, origin[0]), max(0, origin[1])
+    x1 = min(width, origin[0] + mask.shape[1])
+    y1 = min(height, origin[1] + mask.shape[0])
+    if clip_x is not None:
+        x1 = min(x1, math.ceil(clip_x))
+    if x1 <= x0 or y1 <= y0:
+        return frame
+    alpha = mask[y0 - origin[1]:y1 - origin[1], x0 - origin[0]:x1 - origin[0], numpy.newaxis].astype(numpy.uint16)
+    region = frame[y0:y1, x0:x1].astype(numpy.uint16)
+    color = numpy.array(color, dtype=numpy.uint16)
+    frame[y0:y1, x0:x1] = ((region * (255 - alpha) + color * alpha + 127) // 255).astype(numpy.uint8)
+    return frame
+
+
+def count_frames(framedata, frame_specs):
+    '''
+    Total frames the renderer would emit for framedata, without drawing any.
+    '''
+    frames_total = 0
+    for row in load_framedata(framedata):
+        if row.is_linebreak:
+            continue
+        frames_total += sum(shabda_frame_splits(frame_specs['fps'], row.pause_ms, row.shabda))
+    return frames_total
+
+
+def load_font(frame_specs):
+    #ABK default_font = ImageFont.truetype(FRAME_SPECS['font_path'], 73, encoding="unic")
+    return ImageFont.truetype(frame_specs['font_path'], frame_specs['font_height'], encoding="unic")
+
+
+## set per pool process by init_render_worker
+WORKER_RENDER_ROW = None
+
+
+def init_render_worker(frame_specs):
+    global WORKER_RENDER_ROW
+    WORKER_RENDER_ROW = frame_renderer(frame_specs)
+
+
+def render_row_in_worker(row):
+    return WORKER_RENDER_ROW(row)
+
+
+def render_rows_parallel(rows, frame_specs, workers):
+    '''
+    Renders rows over a process pool, at most 2 rows per worker are in flight
+    and results are yielded in submission order so output stays deterministic.
+    '''
+    ## workers come from a forkserver, forking the server itself would copy
+    ## locks other threads may be holding and the worker would hang on them
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('forkserver'),
+            initializer=init_render_worker,
+            initargs=(frame_specs,)) as executor:
+        pending = collections.deque()
+        for row in rows:
+            pending.append(executor.submit(render_row_in_worker, row))
+            if len(pending) >= (workers * 2):
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def render_workers(frame_specs):
+    workers = int(frame_specs.get('render_workers', DEFAULT_RENDER_WORKERS))
+    if workers < 1:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def iterate_layout_frames(rows, frame_specs):
+    workers = render_workers(frame_specs)
+    if workers == 1:
+        render_row = frame_renderer(frame_specs)
+        for row in rows:
+            yield from render_row(row)
+        return
+    yield from render_rows_parallel(rows, frame_specs, workers)
+
+
+def counted_frames(frames):
+    for frame in frames:
+        metrics.inc(metrics.FRAMES_RENDERED)
+        metrics.inc(metrics.FRAMES_SHOWN, frame[3])
+        yield frame
+
+
+def layout_frames(layout, frame_specs):
+    '''
+    Renders LayoutRows as computed by song_layout, any subset of them in any order,
+    yielding (frame_index, subindex, RGB array, repeat) per distinct frame.
+    '''
+    frames = iterate_layout_frames(layout, frame_specs)
+    return counted_frames(metrics.timed_iter(frames, metrics.STAGE_SECONDS, stage='render'))
+
+
+def do_iterate_frames(framedata, frame_specs):
+    return layout_frames(song_layout(framedata, load_font(frame_specs), frame_specs), frame_specs)
+
+
+def save_frames(frames, frames_dir, frame_specs):
+    '''
+    Saves each distinct frame once as PNG and writes the manifest,
+    passes the frames through so it can sit in front of an encoder.
+    '''
+    os.makedirs(frames_dir, exist_ok=True)
+    frames_manifest = []
+    for frame_index, subindex, frame, times in frames:
+        frame_filename = "lvg-%d-%d.png" % (frame_index, subindex)
+        frame_filepath = os.path.join(frames_dir, frame_filename)
+        Image.fromarray(frame).save(frame_filepath, "PNG")
+        metrics.inc(metrics.BYTES_WRITTEN, os.path.getsize(frame_filepath), kind='frames')
+        frames_manifest.append([frame_filename, times])
+        yield (frame_index, subindex, frame, times)
+    frame_size = (frame_specs['width'], frame_specs['height'])
+    write_frames_manifest(frames_dir, frames_manifest, frame_size, frame_specs['fps'])
 
-        y_text = draw_read_line(canvas, line_currently_read, y_text, font, shabda_width)
 
-        create_frame_shabda(canvas, frame_index, y_text, for_millisec, line_currently_read, shabda, font)
-        # cleaning up to avoid corrupted memory errors
-        del canvas
+def do_generate_frames(framedata, frames_dir, frame_specs):
+    frames = do_iterate_frames(framedata, frame_specs)
+    for _ in save_frames(frames, frames_dir, frame_specs):
+        pass
 
-    def text_wrap(frame_lyric, shabda, allowed_characters_in_a_line):
-        if len(frame_lyric) == 0:
-            frame_lyric.append(shabda)
-        elif len(frame_lyric[-1]) == 0:
-            frame_lyric[-1] = shabda
-        elif (len(frame_lyric[-1]) + 1 + len(shabda)) < allowed_characters_in_a_line: #is_frame_lyric_last_line_vacant
-            frame_lyric[-1] = "%s %s" % (frame_lyric[-1], shabda)
-        else:
-            frame_lyric.append(shabda)
-
-        if shabda[-1] in ['.', '"', ';']:
-            frame_lyric.append("")
-        return frame_lyric
-
-    def count_allowed_characters_in_a_line(font):
-        width_of_one_char = (font.getsize("y")[0])
-        usable_frame_space = (FRAME_SPECS['width'] - (2*FRAME_SPECS['margin_left_right']))
-        return math.floor(usable_frame_space / width_of_one_char)
-
-    def framedata_to_frames(frame_data_file):
-        font_height = FRAME_SPECS['font_height']
-        #ABK default_font = ImageFont.truetype(FRAME_SPECS['font_path'], 73, encoding="unic")
-        default_font = ImageFont.truetype(FRAME_SPECS['font_path'], font_height, encoding="unic")
-        allowed_characters_in_a_line = count_allowed_characters_in_a_line(default_font)
-        #ABK _, FRAME_SPECS['font_height'] = default_font.getsize("Trying to keep ^~*,| better height")
-
-        os.makedirs(FRAMES_DIR, exist_ok=True)
-        with open(frame_data_file) as csv_file:
-            csv_reader = csv.reader(csv_file, delimiter=',')
-            line_count = 0
-            frame_lyric = []
-            was_last_line_newline = False
-            for row in csv_reader:
-                shabda = row[0]
-                pause_x = row[1]
-                instructions = row[2].strip().split()
-                if "LINEBREAK" in instructions:
-                    if was_last_line_newline:
-                        frame_lyric = []
-                    was_last_line_newline = True
-                    continue
-                else:
-                    was_last_line_newline = False
-                frame_lyric = text_wrap(frame_lyric, shabda, allowed_characters_in_a_line)
-                print("%s\t'%s'" % (pause_x, frame_lyric))
-                create_frame_image(line_count, pause_x, frame_lyric, shabda, default_font)
-                line_count += 1
-            print('Processed %d lines for %s.' % (line_count, frame_data_file))
 
-    ## calling this internal structure scoped structure
-    FRAME_SPECS = frame_specs
-    FRAMES_PER_SECOND = frame_specs['fps']
-    BASE_IMAGE_FILE = frame_specs['base_image_file']
-    FRAMES_DIR = frames_dir
-    framedata_to_frames(framedata_file)
+def rgb_frames(frames):
+    for _, _, frame, times in frames:
+        yield (frame, times)
 
 
 def base_image_path(bgimage_dir):
@@ -294,14 +378,20 @@ DEFAULT_FRAME_SPECS = {
     'textcolor_next': (255, 135, 84), # light purple
 
     'line_indentation_style': 'left', #default
+    'highlight_style': 'steps', # or 'wipe'
 }
 
 DEFAULT_FRAMES_PER_SECOND = 24  ## common across scripts
 
+## 1 renders in-process, 0 uses a process per cpu core
+DEFAULT_RENDER_WORKERS = int(os.environ.get('LVG_RENDER_WORKERS', '1'))
+
+DEBUG_FRAMES = os.environ.get('LVG_DEBUG_FRAMES', '') not in ['', '0']
+
 BGIMAGE_NAME = 'plain' #'musical-night.jpg'
 
 
-def generate_frames(framedata_file, frames_dir, lvg_dirs, frame_specs=DEFAULT_FRAME_SPECS):
+def with_default_frame_specs(lvg_dirs, frame_specs):
     DEFAULT_FONT_PATH = os.path.join(lvg_dirs['fonts_dir'], DEFAULT_FONT_FILE)
     for default_key, default_val in DEFAULT_FRAME_SPECS.items():
         if default_key not in frame_specs.keys():
@@ -316,5 +406,22 @@ def generate_frames(framedata_file, frames_dir, lvg_dirs, frame_specs=DEFAULT_FR
             frame_specs['base_image_file'] = os.path.join(lvg_dirs['bgimages_dir'], bgimage_name)
         else:
             frame_specs['base_image_file'] = os.path.join(lvg_dirs['bgimages_dir'], BGIMAGE_NAME)
-    do_generate_frames(framedata_file, frames_dir, frame_specs)
     return frame_specs
+
+
+def generate_frames(framedata, frames_dir, lvg_dirs, frame_specs=DEFAULT_FRAME_SPECS):
+    frame_specs = with_default_frame_specs(lvg_dirs, frame_specs)
+    do_generate_frames(framedata, frames_dir, frame_specs)
+    return frame_specs
+
+
+def generate_frames_stream(framedata, lvg_dirs, frame_specs=DEFAULT_FRAME_SPECS, frames_dir=None):
+    '''
+    Resolves frame_specs in place and returns a generator of (RGB array, repeat)
+    for stream_video; frames only land in frames_dir when LVG_DEBUG_FRAMES is set.
+    '''
+    frame_specs = with_default_frame_specs(lvg_dirs, frame_specs)
+    frames = do_iterate_frames(framedata, frame_specs)
+    if DEBUG_FRAMES and frames_dir is not None:
+        frames = save_frames(frames, frames_dir, frame_specs)
+    return rgb_frames(frames)
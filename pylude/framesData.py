@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import csv
+import hashlib
+import json
+
+
+## instruction flags a framedata row can carry
+FLAG_LINEBREAK = 1
+
+INSTRUCTION_FLAGS = {
+    'LINEBREAK': FLAG_LINEBREAK,
+}
+
+
+class FramedataRow:
+    '''
+    One word of framedata shown for pause_ms, or an instruction row such as
+    a LINEBREAK; consecutive linebreaks mean a page break.
+    '''
+    __slots__ = ('shabda', 'pause_ms', 'flags')
+
+    def __init__(self, shabda, pause_ms, flags=0):
+        self.shabda = shabda
+        self.pause_ms = int(pause_ms)
+        self.flags = flags
+
+    @property
+    def is_linebreak(self):
+        return bool(self.flags & FLAG_LINEBREAK)
+
+    def instructions(self):
+        return [name for name, flag in INSTRUCTION_FLAGS.items() if self.flags & flag]
+
+    def __repr__(self):
+        return "FramedataRow(%r, %d, %d)" % (self.shabda, self.pause_ms, self.flags)
+
+
+def instruction_flags(instructions):
+    flags = 0
+    for instruction in instructions.strip().split():
+        flags |= INSTRUCTION_FLAGS.get(instruction, 0)
+    return flags
+
+
+def read_framedata_csv(framedata_file):
+    '''
+    Imports framedata from the CSV of [word, pause_ms, instructions] rows.
+    '''
+    with open(framedata_file, newline='') as csv_file:
+        return [FramedataRow(row[0], row[1], instruction_flags(row[2]))
+                for row in csv.reader(csv_file, delimiter=',')]
+
+
+def write_framedata_csv(framedata, framedata_file):
+    with open(framedata_file, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        for row in framedata:
+            writer.writerow([row.shabda, row.pause_ms, " ".join(row.instructions())])
+    return framedata_file
+
+
+def load_framedata(framedata):
+    '''
+    Framedata as a list of FramedataRow, given either that list or a CSV file path.
+    '''
+    if isinstance(framedata, str):
+        return read_framedata_csv(framedata)
+    return framedata
+
+
+def framedata_digest(framedata):
+    rows = [[row.shabda, row.pause_ms, row.flags] for row in load_framedata(framedata)]
+    return hashlib.sha256(json.dumps(rows).encode()).hexdigest()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+import logging
+import re
+
+from . import metrics
+from . framesData import load_framedata
+
+logger = logging.getLogger(__name__)
+
+
+## text measurements by (font file, font size, text), kept for the life of the process
+TEXT_SIZES = {}
+TEXT_ADVANCES = {}
+TEXT_MEASURES_LIMIT = 65536
+
+LINE_NEEDS_BREAK = re.compile(r".*[\.,!\:;\?]\s*$")
+
+## a word ending in one of these closes its line
+LINE_CLOSING_CHARACTERS = ['.', '"', ';']
+
+
+class LayoutRow:
+    '''
+    Everything drawn for one word: lines already read as (text, x, y), the line
+    being read, where the word itself gets highlighted and whether it is previewed.
+    '''
+    __slots__ = ('frame_index', 'pause_ms', 'shabda', 'read_lines', 'current_line', 'shabda_xy', 'show_next')
+
+    def __init__(self, frame_index, pause_ms, shabda, read_lines, current_line, shabda_xy, show_next):
+        self.frame_index = frame_index
+        self.pause_ms = pause_ms
+        self.shabda = shabda
+        self.read_lines = read_lines
+        self.current_line = current_line
+        self.shabda_xy = shabda_xy
+        self.show_next = show_next
+
+
+def measured(cache, key, measure):
+    value = cache.get(key)
+    if value is None:
+        if len(cache) >= TEXT_MEASURES_LIMIT:
+            cache.clear()
+        value = cache[key] = measure()
+    return value
+
+
+def text_width(font, text):
+    ## ink width as drawn, what line placement has always been based on
+    return measured(TEXT_SIZES, (font.path, font.size, text), lambda: font.getsize(text)[0])
+
+
+def text_advance(font, text):
+    return measured(TEXT_ADVANCES, (font.path, font.size, text), lambda: font.getlength(text))
+
+
+def line_step(frame_specs):
+    return frame_specs['font_height'] + frame_specs['default_line_gap']
+
+
+def allowed_line_count(frame_specs):
+    possible_count = int(frame_specs['height'] / (frame_specs['margin_top'] + line_step(frame_specs)))
+    return min(possible_count, frame_specs['max_lines_per_frame'])
+
+
+def line_x_middle(frame_specs, line_width, shabda_width):
+    x_text = (frame_specs['width'] - line_width) / 2
+    if (line_width + shabda_width) < frame_specs['width']: x_text -= (shabda_width/2)
+    return x_text
+
+
+def line_shabda_x_middle(frame_specs, line_width, shabda_width):
+    x_text = line_x_middle(frame_specs, line_width, shabda_width)
+    x_shabda = (frame_specs['width'] - shabda_width) / 2
+    if (x_text + line_width + shabda_width + frame_specs['margin_left_right']) < frame_specs['width']:
+        x_shabda = x_text + line_width
+    return x_shabda
+
+
+def line_x_left(frame_specs, _line_width, _shabda_width):
+    return frame_specs['margin_left_right']
+
+
+def line_shabda_x_left(frame_specs, line_width, shabda_width):
+    x_text = frame_specs['margin_left_right']
+    x_shabda = frame_specs['margin_left_right']
+
+    if (x_text + line_width + frame_specs['margin_left_right']) < frame_specs['width']:
+        x_shabda = x_text + line_width - shabda_width
+    return x_shabda
+
+
+LINE_X = {
+    'default': line_x_middle,
+    'middle': line_x_middle,
+    'left': line_x_left,
+}
+
+LINE_SHABDA_X = {
+    'default': line_shabda_x_middle,
+    'middle': line_shabda_x_middle,
+    'left': line_shabda_x_left,
+}
+
+
+def wrap_shabda(lines, line_advances, shabda, shabda_advance, space_advance, usable_width):
+    '''
+    Adds shabda to the last line when it fits within usable_width pixels,
+    on a new line otherwise; lines and their advance widths get updated in place.
+    '''
+    if len(lines) == 0:
+        lines.append(shabda)
+        line_advances.append(shabda_advance)
+    elif len(lines[-1]) == 0:
+        lines[-1] = shabda
+        line_advances[-1] = shabda_advance
+    elif (line_advances[-1] + space_advance + shabda_advance) <= usable_width:
+        lines[-1] = "%s %s" % (lines[-1], shabda)
+        line_advances[-1] += space_advance + shabda_advance
+    else:
+        lines.append(shabda)
+        line_advances.append(shabda_advance)
+
+    if shabda[-1:] in LINE_CLOSING_CHARACTERS:
+        lines.append("")
+        line_advances.append(0)
+
+
+def wrapped_pages(framedata, font, frame_specs):
+    '''
+    Yields (row, lines) per word, lines being the page so far with the word
+    wrapped in; consecutive LINEBREAK rows start a new page.
+    '''
+    usable_width = frame_specs['width'] - (2 * frame_specs['margin_left_right'])
+    space_advance = text_advance(font, ' ')
+    lines = []
+    line_advances = []
+    was_last_line_newline = False
+    for row in load_framedata(framedata):
+        if row.is_linebreak:
+            if was_last_line_newline:
+                lines = []
+                line_advances = []
+            was_last_line_newline = True
+            continue
+        else:
+            was_last_line_newline = False
+        wrap_shabda(lines, line_advances, row.shabda, text_advance(font, row.shabda), space_advance, usable_width)
+        yield row, lines
+
+
+def song_layout(framedata, font, frame_specs):
+    '''
+    Lays out the whole song up front, one LayoutRow per word with every line
+    break, page break and position resolved so rendering is only drawing.
+    '''
+    with metrics.timed(metrics.STAGE_SECONDS, stage='layout'):
+        layout = do_song_layout(framedata, font, frame_specs)
+    logger.info('Laid out %d words of framedata.', len(layout))
+    return layout
+
+
+def do_song_layout(framedata, font, frame_specs):
+    lines_to_use = allowed_line_count(frame_specs)
+    line_x = LINE_X[frame_specs['line_indentation_style']]
+    line_shabda_x = LINE_SHABDA_X[frame_specs['line_indentation_style']]
+
+    layout = []
+    for frame_index, (row, lines) in enumerate(wrapped_pages(framedata, font, frame_specs)):
+        line_to_add_from = max(0, len(lines) - lines_to_use)
+        y_text = frame_specs['margin_top']
+        read_lines = []
+        for line in lines[line_to_add_from:-1]:
+            read_lines.append((line, line_x(frame_specs, text_width(font, line), 0), y_text))
+            y_text += line_step(frame_specs)
+
+        current_line = lines[-1]
+        line_width = text_width(font, current_line)
+        shabda_width = text_width(font, ' ' + row.shabda)
+        ## a line closed by punctuation gets placed as if no word follows it
+        line_shabda_width = 0 if LINE_NEEDS_BREAK.match(current_line) else shabda_width
+        layout.append(LayoutRow(
+            frame_index,
+            row.pause_ms,
+            row.shabda,
+            tuple(read_lines),
+            (current_line, line_x(frame_specs, line_width, line_shabda_width), y_text),
+            (line_shabda_x(frame_specs, line_width, shabda_width), y_text),
+            len(current_line) > 0,
+        ))
+        logger.debug("%s\t'%s'", row.pause_ms, lines)
+    return layout
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+import json
+import os
+
+
+FRAMES_MANIFEST_FILE = 'manifest.json'
+
+
+def manifest_path(frames_dir):
+    return os.path.join(frames_dir, FRAMES_MANIFEST_FILE)
+
+
+def write_frames_manifest(frames_dir, frames, size, fps):
+    '''
+    frames is an ordered list of [frame_filename, repeat_count],
+    each distinct frame is saved once and repeated at encode time;
+    size and fps are recorded so encoding needs no look at the frames
+    '''
+    manifest = {
+        'size': list(size),
+        'fps': fps,
+        'frames': [
+            {'file': frame, 'repeat': repeat, 'duration_ms': round(1000 * repeat / fps)}
+            for frame, repeat in frames
+        ],
+    }
+    with open(manifest_path(frames_dir), 'w') as fp:
+        json.dump(manifest, fp)
+    return manifest_path(frames_dir)
+
+
+def read_frames_manifest(frames_dir):
+    '''
+    Returns {'size', 'fps', 'frames': [(frame_filename, repeat_count)]} or None
+    for frame dirs without a manifest.
+    '''
+    filepath = manifest_path(frames_dir)
+    if not os.path.isfile(filepath):
+        return None
+    with open(filepath) as fp:
+        manifest = json.load(fp)
+    return {
+        'size': tuple(manifest['size']),
+        'fps': manifest['fps'],
+        'frames': [(frame['file'], int(frame['repeat'])) for frame in manifest['frames']],
+    }
+
@@ -1,34 +1,46 @@
 #!/usr/bin/env python
 
-import csv
+import logging
 import os
 
+from . import metrics
+from . framesData import FramedataRow, FLAG_LINEBREAK, write_framedata_csv
+
+logger = logging.getLogger(__name__)
+
 
 DEFAULT_WORD_PAUSE_MILLISECOND = '500'
 if 'LVG_WORD_PAUSE_MS' in os.environ.keys():
     DEFAULT_WORD_PAUSE_MILLISECOND = os.environ['LVG_WORD_PAUSE_MS']
 
 
+def script_framedata(script_filepath, word_pause=DEFAULT_WORD_PAUSE_MILLISECOND):
+    '''
+    Framedata of a lyrics script as a list of FramedataRow, ready for the renderer.
+    '''
+    with metrics.timed(metrics.STAGE_SECONDS, stage='framedata'):
+        with open(script_filepath, encoding='utf-8') as fp:
+            script_lines = fp.readlines()
+        framedata = []
+        for line in script_lines:
+            line_to_framedata(framedata, line, word_pause)
+    return framedata
+
+
 def script_to_framedata(framedata_dir, script_filepath, word_pause):
     lvg_framedata_file = os.path.join(
         framedata_dir,
         os.path.basename(script_filepath)
     )
-    script_lines = open(script_filepath, encoding='utf-8').readlines()
-
-    with open(lvg_framedata_file, 'w', newline='') as file:
-        writer = csv.writer(file)
-        for line in script_lines:
-            line_to_framedata(writer, line, word_pause)
-    return lvg_framedata_file
+    framedata = script_framedata(script_filepath, word_pause)
+    return write_framedata_csv(framedata, lvg_framedata_file)
 
 
-def line_to_framedata(writer, line, word_pause):
+def line_to_framedata(framedata, line, word_pause):
     for shabda in line.strip().split():
-        line_list = [shabda, word_pause, ""]
-        writer.writerow(line_list)
+        framedata.append(FramedataRow(shabda, word_pause))
     # on decipher consecutive linebreak would mean explicit pagebreak
-    writer.writerow(["", word_pause, "LINEBREAK"])
+    framedata.append(FramedataRow("", word_pause, FLAG_LINEBREAK))
 
 
 def generate_framedata(script_filepath, framedata_dir):
@@ -38,8 +50,9 @@ def generate_framedata(script_filepath, framedata_dir):
             script_filepath,
             DEFAULT_WORD_PAUSE_MILLISECOND
         )
-        print(lvg_framedata_file)
+        metrics.inc(metrics.BYTES_WRITTEN, os.path.getsize(lvg_framedata_file), kind='framedata')
+        logger.info(lvg_framedata_file)
         return lvg_framedata_file
     except Exception as e:
-        print(e)
+        logger.error(e)
         return None
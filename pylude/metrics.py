@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+'''
+Process-wide counters, gauges and histograms, exposed in Prometheus text format.
+Metrics get declared once with define() and updated by name with labels as kwargs;
+render worker processes keep their own copy, so only the parent's figures show up.
+'''
+
+import bisect
+import contextlib
+import threading
+import time
+
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+METRICS = {}
+METRICS_LOCK = threading.Lock()
+
+
+def define(name, kind, help_text, buckets=STAGE_BUCKETS):
+    '''
+    Declares a 'counter', 'gauge' or 'histogram', declaring it again keeps the existing one.
+    '''
+    with METRICS_LOCK:
+        if name not in METRICS:
+            METRICS[name] = {
+                'kind': kind,
+                'help': help_text,
+                'buckets': tuple(buckets) if kind == 'histogram' else None,
+                'values': {},
+            }
+    return name
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    metric = METRICS[name]
+    key = label_key(labels)
+    with METRICS_LOCK:
+        metric['values'][key] = metric['values'].get(key, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    metric = METRICS[name]
+    with METRICS_LOCK:
+        metric['values'][label_key(labels)] = value
+
+
+def observe(name, value, **labels):
+    metric = METRICS[name]
+    key = label_key(labels)
+    with METRICS_LOCK:
+        if key not in metric['values']:
+            metric['values'][key] = {'counts': [0] * len(metric['buckets']), 'sum': 0.0, 'count': 0}
+        histogram = metric['values'][key]
+        bucket_index = bisect.bisect_left(metric['buckets'], value)
+        if bucket_index < len(metric['buckets']):
+            histogram['counts'][bucket_index] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+@contextlib.contextmanager
+def timed(name, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+@contextlib.contextmanager
+def in_flight(name, **labels):
+    inc(name, 1, **labels)
+    try:
+        yield
+    finally:
+        inc(name, -1, **labels)
+
+
+def timed_iter(iterable, name, **labels):
+    '''
+    Passes iterable through, observing the total time spent producing its items
+    once it is exhausted or closed; time the consumer takes is left out.
+    '''
+    spent = 0.0
+    iterator = iter(iterable)
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                spent += time.perf_counter() - started
+                return
+            spent += time.perf_counter() - started
+            yield item
+    finally:
+        observe(name, spent, **labels)
+
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for label, value in pairs)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def exposition():
+    '''
+    All metrics in the Prometheus text exposition format, version 0.0.4.
+    '''
+    lines = []
+    with METRICS_LOCK:
+        for name, metric in sorted(METRICS.items()):
+            lines.append('# HELP %s %s' % (name, metric['help']))
+            lines.append('# TYPE %s %s' % (name, metric['kind']))
+            for key, value in sorted(metric['values'].items()):
+                if metric['kind'] != 'histogram':
+                    lines.append('%s%s %s' % (name, format_labels(key), format_value(value)))
+                    continue
+                cumulative = 0
+                for bucket, count in zip(metric['buckets'], value['counts']):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (name, format_labels(key, [('le', format_value(bucket))]), cumulative))
+                lines.append('%s_bucket%s %d' % (name, format_labels(key, [('le', '+Inf')]), value['count']))
+                lines.append('%s_sum%s %s' % (name, format_labels(key), format_value(value['sum'])))
+                lines.append('%s_count%s %d' % (name, format_labels(key), value['count']))
+    return '\n'.join(lines) + '\n'
+
+
+## shared by pylude and the app serving it
+STAGE_SECONDS = define('lvg_stage_seconds', 'histogram', "Wall time spent per pipeline stage.")
+FRAMES_RENDERED = define('lvg_frames_rendered_total', 'counter', "Distinct frames drawn.")
+FRAMES_SHOWN = define('lvg_video_frames_total', 'counter', "Video frames emitted, repeats included.")
+CACHE_HITS = define('lvg_cache_hits_total', 'counter', "Cache lookups served from cache.")
+CACHE_MISSES = define('lvg_cache_misses_total', 'counter', "Cache lookups that had to compute.")
+BYTES_WRITTEN = define('lvg_bytes_written_total', 'counter', "Bytes written to disk by kind of output.")
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import os
+
+from . framesData import framedata_digest
+
+## bump when a change to rendering makes earlier videos stale
+RENDER_CACHE_VERSION = 3
+
+## frame_specs keys that change how a render runs, never what it looks like
+RENDER_RUNTIME_SPECS = ['render_workers']
+
+FILE_DIGESTS = {}
+
+
+def hash_file(filepath):
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def file_digest(filepath):
+    '''
+    SHA-256 of a font or background, remembered per (path, size, mtime)
+    so they get hashed once per process.
+    '''
+    stat = os.stat(filepath)
+    digest_key = (filepath, stat.st_size, stat.st_mtime)
+    if digest_key not in FILE_DIGESTS:
+        FILE_DIGESTS[digest_key] = hash_file(filepath)
+    return FILE_DIGESTS[digest_key]
+
+
+def render_specs(frame_specs):
+    '''
+    frame_specs as far as they change what gets drawn, with font and background
+    files replaced by their digests.
+    '''
+    specs = {key: value for key, value in frame_specs.items()
+                if key not in RENDER_RUNTIME_SPECS}
+    specs['font_path'] = file_digest(frame_specs['font_path'])
+    if os.path.isfile(frame_specs['base_image_file']):
+        specs['base_image_file'] = file_digest(frame_specs['base_image_file'])
+    else:
+        specs['base_image_file'] = None  ## plain bgcolor background
+    return specs
+
+
+def render_key(framedata, frame_specs, audio_digest, encode_preset=None, frame_rate_mode='cfr', output_format='mp4'):
+    '''
+    Digest of everything a finished video depends on, frame_specs is expected
+    to be resolved already so defaults are part of the key as well; framedata
+    hashes the same whether given as rows or as its CSV.
+    '''
+    render_inputs = {
+        'version': RENDER_CACHE_VERSION,
+        'framedata': framedata_digest(framedata),
+        'frame_specs': render_specs(frame_specs),
+        'audio': audio_digest,
+        'encode_preset': encode_preset,
+        'frame_rate_mode': frame_rate_mode,
+        'output_format': output_format,
+    }
+    return hashlib.sha256(json.dumps(render_inputs, sort_keys=True).encode()).hexdigest()
+
+
+def segment_key(layout_rows, frame_specs, encode_preset, tail_frames):
+    '''
+    Digest of an encoded run of LayoutRows, where the run sits in the song is
+    left out so it keeps its key when words get added or removed before it.
+    '''
+    rows = [[row.shabda, row.pause_ms, row.read_lines, row.current_line, row.shabda_xy, row.show_next]
+            for row in layout_rows]
+    segment_inputs = {
+        'version': RENDER_CACHE_VERSION,
+        'frame_specs': render_specs(frame_specs),
+        'rows': rows,
+        'encode_preset': encode_preset,
+        'tail_frames': tail_frames,
+    }
+    return hashlib.sha256(json.dumps(segment_inputs, sort_keys=True).encode()).hexdigest()
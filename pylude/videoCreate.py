@@ -2,11 +2,21 @@
 
 import os
 import cv2
+import logging
 import re
 import sys
+import time
 from PIL import Image
 import ffmpeg
 
+from . import metrics
+from . framesManifest import read_frames_manifest
+
+logger = logging.getLogger(__name__)
+
+
+TAIL_FRAME_REPEAT_COUNT = 48
+
 
 def atoi(text):
     return int(text) if text.isdigit() else text
@@ -51,7 +61,7 @@ def resize_frames(frames_dir, list_of_frames, size):
         imResize = im.resize(size, Image.ANTIALIAS)
         imResize.save(framepath, 'PNG', quality = 100) # setting quality
         # printing each resized image name
-        print("resized:", frame)
+        logger.debug("resized: %s", frame)
 
 
 def do_generate_video(frames_dir, list_of_frames, video_spec):
@@ -64,47 +74,270 @@ def do_generate_video(frames_dir, list_of_frames, video_spec):
 
     video = cv2.VideoWriter(video_file, fourcc, video_fps, video_size, True)
 
-    last_framepath = None
-    for frame in list_of_frames:
-        print("adding frame:", frame)
+    last_frame = None
+    for frame, repeat in list_of_frames:
+        logger.debug("adding frame: %s", frame)
         framepath = os.path.join(frames_dir, frame)
-        video.write(cv2.imread(framepath))
-        last_framepath = framepath
+        last_frame = cv2.imread(framepath)
+        for _ in range(repeat):
+            video.write(last_frame)
     for _ in range(frame_repeat_count):
-        video.write(cv2.imread(last_framepath))
+        video.write(last_frame)
 
     cv2.destroyAllWindows() # Deallocating memories taken for window creation
     video.release()  # releasing the video generated
 
 
-def generate_video(frames_dir, video_file, video_fps):
+def generate_video(frames_dir, video_file, video_fps=None):
     if os.path.isfile(video_file):
         return
-    all_frames = listframes(frames_dir)
-    if all_frames == None or len(all_frames) == 0:
-        print("found no frames at %s" % (frames_dir))
+    manifest = read_frames_manifest(frames_dir)
+    if manifest == None:
+        ## frames dir without manifest, every shown frame is its own file
+        manifest = {
+            'size': None,
+            'fps': None,
+            'frames': [(frame, 1) for frame in listframes(frames_dir)],
+        }
+    all_frames = manifest['frames']
+    if len(all_frames) == 0:
+        logger.error("found no frames at %s", frames_dir)
         sys.exit(1)
-    video_size = get_video_size(frames_dir, all_frames)
+    video_size = manifest['size']
+    if video_size == None:
+        video_size = get_video_size(frames_dir, [frame for frame, _ in all_frames])
+    if video_fps == None:
+        video_fps = manifest['fps']
     #resize_frames(frames_dir, all_frames, video_size)
     video_spec = {
         'filepath': video_file,
         'size': video_size,
         'fps': video_fps,
-        'frame-repeat-count': 48,
+        'frame-repeat-count': TAIL_FRAME_REPEAT_COUNT,
+    }
+    with metrics.timed(metrics.STAGE_SECONDS, stage='encode'):
+        do_generate_video(frames_dir, all_frames, video_spec)
+    written_bytes(video_file)
+
+
+def written_bytes(filepath, kind='video'):
+    if os.path.isfile(filepath):
+        metrics.inc(metrics.BYTES_WRITTEN, os.path.getsize(filepath), kind=kind)
+
+
+def opencv_frame_writer(video_spec):
+    fourcc = cv2.VideoWriter_fourcc(*'MJPG')
+    video = cv2.VideoWriter(video_spec['filepath'], fourcc, video_spec['fps'], video_spec['size'], True)
+
+    def write_frame(rgb_frame, repeat):
+        bgr_frame = cv2.cvtColor(rgb_frame, cv2.COLOR_RGB2BGR)
+        for _ in range(repeat):
+            video.write(bgr_frame)
+
+    def close():
+        video.release()
+    return write_frame, close
+
+
+def ffmpeg_frame_writer(video_spec):
+    width, height = video_spec['size']
+    ff_video = ffmpeg.input('pipe:', format='rawvideo', pix_fmt='rgb24',
+                            s='%dx%d' % (width, height), framerate=video_spec['fps'])
+    streams = [ff_video.video]
+    output_args = {'pix_fmt': 'yuv420p'}
+    if video_spec.get('preset') is not None:
+        output_args.update(ENCODE_PRESETS[video_spec['preset']])
+    if video_spec.get('audio_file') is not None:
+        streams.append(ffmpeg.input(video_spec['audio_file']).audio)
+        output_args.update({'acodec': 'aac', 'audio_bitrate': '192k'})
+    ## output_args override the above, a None value drops the argument
+    output_args.update(video_spec.get('output_args', {}))
+    output_args = {name: value for name, value in output_args.items() if value is not None}
+    process = (
+        ffmpeg
+        .output(*streams, video_spec['filepath'], **output_args)
+        .overwrite_output()
+        .run_async(pipe_stdin=True)
+    )
+
+    def write_frame(rgb_frame, repeat):
+        frame_bytes = rgb_frame.tobytes()
+        for _ in range(repeat):
+            process.stdin.write(frame_bytes)
+
+    def close():
+        process.stdin.close()
+        if process.wait() != 0:
+            raise RuntimeError("ffmpeg failed to encode %s" % video_spec['filepath'])
+    return write_frame, close
+
+
+FRAME_WRITERS = {
+    'opencv': opencv_frame_writer,
+    'ffmpeg': ffmpeg_frame_writer,
+}
+
+## x264 speed/quality trade-offs for encode_video
+ENCODE_PRESETS = {
+    'fast': {'vcodec': 'libx264', 'preset': 'veryfast', 'crf': 26, 'movflags': '+faststart'},
+    'balanced': {'vcodec': 'libx264', 'preset': 'medium', 'crf': 23, 'movflags': '+faststart'},
+    'quality': {'vcodec': 'libx264', 'preset': 'slow', 'crf': 18, 'movflags': '+faststart'},
+}
+
+DEFAULT_ENCODE_PRESET = 'balanced'
+
+## short segments let HLS playback start soon after rendering does
+HLS_SEGMENT_SECONDS = 2
+
+
+def do_stream_video(frames, video_spec, frame_writer):
+    ## frames get rendered while this loop pulls them, only writer time counts as encode
+    write_frame, close = frame_writer(video_spec)
+    encode_seconds = 0.0
+    last_frame = None
+    try:
+        for rgb_frame, repeat in frames:
+            started = time.perf_counter()
+            write_frame(rgb_frame, repeat)
+            encode_seconds += time.perf_counter() - started
+            last_frame = rgb_frame
+        if last_frame is None:
+            logger.warning("found no frames to stream into %s", video_spec['filepath'])
+            return
+        started = time.perf_counter()
+        write_frame(last_frame, video_spec['frame-repeat-count'])
+        encode_seconds += time.perf_counter() - started
+    finally:
+        started = time.perf_counter()
+        close()
+        encode_seconds += time.perf_counter() - started
+        metrics.observe(metrics.STAGE_SECONDS, encode_seconds, stage='encode')
+    written_bytes(video_spec['filepath'])
+
+
+def stream_video(frames, video_file, video_fps, video_size, encoder='opencv'):
+    '''
+    frames is an iterable of (RGB array, repeat) as yielded by generate_frames_stream,
+    they are handed to the encoder as they get rendered without touching disk
+    '''
+    if os.path.isfile(video_file):
+        return
+    video_spec = {
+        'filepath': video_file,
+        'size': video_size,
+        'fps': video_fps,
+        'frame-repeat-count': TAIL_FRAME_REPEAT_COUNT,
+    }
+    do_stream_video(frames, video_spec, FRAME_WRITERS[encoder])
+
+
+def encode_video(frames, audio_file, video_file, video_fps, video_size, preset=DEFAULT_ENCODE_PRESET):
+    '''
+    Single ffmpeg process compressing streamed frames to H.264 and muxing the audio
+    as AAC, replaces stream_video followed by attach_audio.
+    '''
+    if os.path.isfile(video_file):
+        return
+    video_spec = {
+        'filepath': video_file,
+        'size': video_size,
+        'fps': video_fps,
+        'frame-repeat-count': TAIL_FRAME_REPEAT_COUNT,
+        'audio_file': audio_file,
+        'preset': preset,
+    }
+    do_stream_video(frames, video_spec, ffmpeg_frame_writer)
+
+
+def encode_video_vfr(frames, audio_file, video_file, video_fps, video_size, preset=DEFAULT_ENCODE_PRESET):
+    '''
+    Like encode_video, but repeats of a frame are dropped before x264 sees them
+    and the ones kept hold their timestamps, so each held frame gets encoded once.
+    '''
+    if os.path.isfile(video_file):
+        return
+    video_spec = {
+        'filepath': video_file,
+        'size': video_size,
+        'fps': video_fps,
+        'frame-repeat-count': TAIL_FRAME_REPEAT_COUNT,
+        'audio_file': audio_file,
+        'preset': preset,
+        'output_args': {
+            ## only exact repeats get dropped, a held frame is kept again every
+            ## TAIL_FRAME_REPEAT_COUNT frames so the video ends no sooner than that
+            'vf': 'mpdecimate=hi=0:lo=0:frac=0:max=%d' % (TAIL_FRAME_REPEAT_COUNT - 1),
+            'fps_mode': 'vfr',
+        },
+    }
+    do_stream_video(frames, video_spec, ffmpeg_frame_writer)
+
+
+def hls_playlist_complete(playlist_file):
+    if not os.path.isfile(playlist_file):
+        return False
+    with open(playlist_file) as fp:
+        return '#EXT-X-ENDLIST' in fp.read()
+
+
+def hls_files(playlist_file):
+    '''
+    Playlist, init segment and media segments written for playlist_file,
+    along with the temp files of any of them still being written.
+    '''
+    playlist_dir, playlist_name = os.path.split(playlist_file)
+    prefix = os.path.splitext(playlist_name)[0] + '-'
+    return [os.path.join(playlist_dir, name) for name in os.listdir(playlist_dir)
+            if name.startswith((playlist_name, prefix))]
+
+
+def encode_video_hls(frames, audio_file, playlist_file, video_fps, video_size, preset=DEFAULT_ENCODE_PRESET,
+                     segment_seconds=HLS_SEGMENT_SECONDS):
+    '''
+    Like encode_video, but as an HLS event playlist of fragmented MP4 segments
+    carrying video and audio both; ffmpeg rewrites the playlist as each segment
+    completes so players can start while frames are still being rendered.
+    '''
+    if hls_playlist_complete(playlist_file):
+        return
+    playlist_dir, playlist_name = os.path.split(playlist_file)
+    prefix = os.path.splitext(playlist_name)[0]
+    output_args = {
+        'format': 'hls',
+        'hls_time': segment_seconds,
+        'hls_playlist_type': 'event',
+        'hls_segment_type': 'fmp4',
+        'hls_flags': 'independent_segments+temp_file',
+        'hls_fmp4_init_filename': prefix + '-init.mp4',
+        'hls_segment_filename': os.path.join(playlist_dir, prefix + '-%05d.m4s'),
+        ## a keyframe at every segment boundary, so segments come out segment_seconds long
+        'force_key_frames': 'expr:gte(t,n_forced*%d)' % segment_seconds,
+        'movflags': None,  ## faststart is for whole files, segments get their own moof boxes
+    }
+    video_spec = {
+        'filepath': playlist_file,
+        'size': video_size,
+        'fps': video_fps,
+        'frame-repeat-count': TAIL_FRAME_REPEAT_COUNT,
+        'audio_file': audio_file,
+        'preset': preset,
+        'output_args': output_args,
     }
-    do_generate_video(frames_dir, all_frames, video_spec)
+    do_stream_video(frames, video_spec, ffmpeg_frame_writer)
 
 
 def attach_audio(video_file, audio_file, output_file):
-    print("attach %s with %s to generate %s" % (video_file, audio_file, output_file))
+    logger.info("attach %s with %s to generate %s", video_file, audio_file, output_file)
     if os.path.isfile(output_file):
         return
     try:
         ff_video = ffmpeg.input(video_file)
         ff_audio = ffmpeg.input(audio_file)
         stream = ffmpeg.concat(ff_video, ff_audio, v=1, a=1).output(output_file)
-        stream.run(overwrite_output=True)
+        with metrics.timed(metrics.STAGE_SECONDS, stage='mux'):
+            stream.run(overwrite_output=True)
+        written_bytes(output_file)
         return True
     except Exception as e:
-        print(e)
+        logger.error(e)
         return False
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+'''
+Encodes a song as content-addressed H.264 segments spliced into the final video,
+so after an edit only segments whose lines changed get rendered and encoded again.
+'''
+
+import logging
+import os
+import tempfile
+import time
+
+import ffmpeg
+
+from . import metrics
+from . framesCreate import layout_frames, load_font, shabda_frame_splits
+from . framesData import load_framedata
+from . framesLayout import song_layout
+from . renderCache import segment_key
+from . videoCreate import DEFAULT_ENCODE_PRESET, TAIL_FRAME_REPEAT_COUNT, ffmpeg_frame_writer, written_bytes
+
+logger = logging.getLogger(__name__)
+
+
+## a segment ends at the next line starting after this long, or at a page
+SEGMENT_MIN_SECONDS = 4
+
+
+def segment_layout(layout, frame_specs, min_seconds=SEGMENT_MIN_SECONDS):
+    '''
+    Splits LayoutRows into runs starting at a page, or at a line once the
+    running one lasts min_seconds; boundaries follow the lyrics so an edit
+    only moves the ones near it.
+    '''
+    min_frames = min_seconds * frame_specs['fps']
+    segments = []
+    segment_frames = 0
+    for row in layout:
+        starts_line = row.current_line[0] == row.shabda
+        starts_page = starts_line and len(row.read_lines) == 0
+        if len(segments) == 0 or starts_page or (starts_line and segment_frames >= min_frames):
+            segments.append([])
+            segment_frames = 0
+        segments[-1].append(row)
+        segment_frames += sum(shabda_frame_splits(frame_specs['fps'], row.pause_ms, row.shabda))
+    return segments
+
+
+def segment_frames_count(segment, frame_specs):
+    ## tail repeats left out, like count_frames does
+    return sum(sum(shabda_frame_splits(frame_specs['fps'], row.pause_ms, row.shabda))
+               for row in segment['rows'])
+
+
+def plan_segments(layout, frame_specs, segments_dir, preset):
+    segments = segment_layout(layout, frame_specs)
+    planned = []
+    for position, rows in enumerate(segments):
+        tail = TAIL_FRAME_REPEAT_COUNT if position == len(segments) - 1 else 0
+        key = segment_key(rows, frame_specs, preset, tail)
+        planned.append({'filepath': os.path.join(segments_dir, key + '.mp4'), 'rows': rows, 'tail': tail})
+    return planned
+
+
+def encode_segments(segments, frame_specs, preset, on_frames):
+    '''
+    Renders the rows of all segments in one pass, each segment's frames go to
+    an encoder of its own which is swapped as rendering moves to the next one.
+    '''
+    segment_of_row = {}
+    for segment in segments:
+        for row in segment['rows']:
+            segment_of_row[row.frame_index] = segment
+    video_spec = {
+        'size': (frame_specs['width'], frame_specs['height']),
+        'fps': frame_specs['fps'],
+        'preset': preset,
+    }
+    rows = [row for segment in segments for row in segment['rows']]
+    state = {'segment': None, 'writer': None, 'part_file': None, 'last_frame': None, 'encode_seconds': 0.0}
+
+    def finish_segment():
+        write_frame, close = state['writer']
+        started = time.perf_counter()
+        if state['segment']['tail'] > 0:
+            write_frame(state['last_frame'], state['segment']['tail'])
+        state['writer'] = None
+        close()
+        os.replace(state['part_file'], state['segment']['filepath'])
+        state['encode_seconds'] += time.perf_counter() - started
+        written_bytes(state['segment']['filepath'], kind='segment')
+
+    try:
+        for frame_index, _, frame, times in layout_frames(rows, frame_specs):
+            segment = segment_of_row[frame_index]
+            if segment is not state['segment']:
+                if state['writer'] is not None:
+                    finish_segment()
+                state['segment'] = segment
+                state['part_file'] = part_filepath(segment)
+                state['writer'] = ffmpeg_frame_writer(dict(video_spec, filepath=state['part_file']))
+            started = time.perf_counter()
+            state['writer'][0](frame, times)
+            state['encode_seconds'] += time.perf_counter() - started
+            state['last_frame'] = frame
+            on_frames(times)
+        if state['writer'] is not None:
+            finish_segment()
+    finally:
+        if state['writer'] is not None:
+            try:
+                state['writer'][1]()
+            finally:
+                os.remove(state['part_file'])
+        metrics.observe(metrics.STAGE_SECONDS, state['encode_seconds'], stage='encode')
+
+
+def part_filepath(segment):
+    ## a name of its own per writer, jobs may be encoding the same segment at once
+    segments_dir, segment_name = os.path.split(segment['filepath'])
+    fd, part_file = tempfile.mkstemp(prefix='.' + os.path.splitext(segment_name)[0] + '-',
+                                     suffix='.part.mp4', dir=segments_dir)
+    os.close(fd)
+    return part_file
+
+
+def splice_segments(segments, audio_file, video_file):
+    concat_file = video_file + '.ffconcat'
+    with open(concat_file, 'w') as fp:
+        fp.write("ffconcat version 1.0\n")
+        for segment in segments:
+            fp.write("file '%s'\n" % os.path.abspath(segment['filepath']).replace("'", "'\\''"))
+    try:
+        streams = [ffmpeg.input(concat_file, format='concat', safe=0).video]
+        output_args = {'vcodec': 'copy', 'movflags': '+faststart'}
+        if audio_file is not None:
+            streams.append(ffmpeg.input(audio_file).audio)
+            output_args.update({'acodec': 'aac', 'audio_bitrate': '192k'})
+        with metrics.timed(metrics.STAGE_SECONDS, stage='mux'):
+            ffmpeg.output(*streams, video_file, **output_args).overwrite_output().run()
+        written_bytes(video_file)
+    finally:
+        os.remove(concat_file)
+
+
+def missing_segments(segments):
+    return [segment for segment in segments if not os.path.isfile(segment['filepath'])]
+
+
+def encode_video_segments(framedata, audio_file, video_file, frame_specs, segments_dir,
+                          preset=DEFAULT_ENCODE_PRESET, on_frames=None, reuse=True):
+    '''
+    Like encode_video, but the song gets encoded as segments cached in segments_dir
+    by what they show; segments an earlier render left there are reused as is and
+    only the rest are rendered, then all of them get spliced along with the audio.
+    frame_specs is expected to be resolved, on_frames gets called with frame counts
+    as they are done, reused segments included and the tail repeats left out;
+    reuse=False renders every segment again.
+    '''
+    if os.path.isfile(video_file):
+        return
+    if on_frames is None:
+        on_frames = lambda frames_count: None
+    os.makedirs(segments_dir, exist_ok=True)
+    layout = song_layout(load_framedata(framedata), load_font(frame_specs), frame_specs)
+    segments = plan_segments(layout, frame_specs, segments_dir, preset)
+    pending = []
+    for segment in segments:
+        if reuse and os.path.isfile(segment['filepath']):
+            os.utime(segment['filepath'])  ## mtime tracks last use for eviction
+            metrics.inc(metrics.CACHE_HITS, cache='segment')
+            on_frames(segment_frames_count(segment, frame_specs))
+        else:
+            metrics.inc(metrics.CACHE_MISSES, cache='segment')
+            pending.append(segment)
+    logger.info("reusing %d of %d segments for %s", len(segments) - len(pending), len(segments), video_file)
+    if len(pending) > 0:
+        encode_segments(pending, frame_specs, preset, on_frames)
+    if len(segments) == 0:
+        logger.warning("found no frames to encode into %s", video_file)
+        return
+    ## segments counted as reused may have been evicted since, they get rendered again
+    evicted = missing_segments(segments)
+    if len(evicted) > 0:
+        logger.info("rendering %d evicted segments again for %s", len(evicted), video_file)
+        encode_segments(evicted, frame_specs, preset, lambda frames_count: None)
+    if len(missing_segments(segments)) > 0:
+        raise RuntimeError("segments of %s went missing before splicing" % video_file)
+    splice_segments(segments, audio_file, video_file)
+
+
+def evict_segments(segments_dir, max_bytes):
+    '''
+    Removes the least recently used segments until the rest fit in max_bytes.
+    '''
+    segments = [os.path.join(segments_dir, name) for name in os.listdir(segments_dir)
+                if name.endswith('.mp4') and not name.endswith('.part.mp4')]
+    segments.sort(key=os.path.getmtime)
+    segments_bytes = sum(os.path.getsize(path) for path in segments)
+    for path in segments:
+        if segments_bytes <= max_bytes:
+            break
+        segments_bytes -= os.path.getsize(path)
+        os.remove(path)